@@ -0,0 +1,820 @@
+"""
+Offline benchmarks for the bot's hot paths.
+
+Nothing here talks to Discord or a real Ollama; every scenario works on a
+throwaway SQLite file in a temporary directory.
+
+Usage:
+    uv run benchmark.py db [--messages 5000] [--opt-in-ratio 0.5]
+    uv run benchmark.py sample [--rows 10000,1000000,10000000]
+    uv run benchmark.py retrieval [--rows 1000000] [--dim 128]
+    uv run benchmark.py stats [--rows 1000000]
+    uv run benchmark.py guilds [--guilds 20] [--messages 200000]
+    uv run benchmark.py dedup [--messages 20000] [--threshold 0.8]
+    uv run benchmark.py prompt [--requests 200] [--num-ctx 4096] [--prompt-token-ms 0.25]
+    uv run benchmark.py pool [--requests 200] [--rate 5] [--load-ms 1000]
+    uv run benchmark.py pipeline [--profile regression] [--rate 50] [--messages 2000]
+
+The pipeline scenario drives LearningBot.on_message with fake Discord
+messages and channels, against stub_ollama.py and a local image server.
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import functools
+import io
+import itertools
+import logging
+import os
+import random
+import sqlite3
+import string
+import tempfile
+import time
+
+import aiosqlite
+import numpy as np
+from aiohttp import web
+from PIL import Image
+
+from database import DatabaseManager
+from llm import OllamaClient, OllamaEndpoint, OllamaPool
+from metrics import metrics
+from prompt import (HISTORY_HEADER, IDENTITY, INSTRUCTIONS, VIBE_HEADER, PromptBuilder, estimate_tokens,
+                    request_text)
+from retrieval import EmbeddingIndex, HashingEmbedder, normalize
+from stub_ollama import StubOllama
+
+
+def random_text(rng, min_words=2, max_words=12):
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 8)))
+             for _ in range(rng.randint(min_words, max_words))]
+    return " ".join(words)
+
+
+def report(label, count, elapsed):
+    per_item = elapsed / count * 1e6 if count else 0.0
+    rate = count / elapsed if elapsed else float("inf")
+    print(f"{label:<28} {per_item:>10.1f} us/msg {rate:>12.0f} msg/s")
+
+
+class ConnectPerCallDatabase(DatabaseManager):
+    """The pre-pooling access pattern: a fresh aiosqlite connection per query."""
+
+    async def is_opted_in(self, user_id: int) -> bool:
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute("SELECT opt_in FROM user_prefs WHERE user_id = ?", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+                return bool(row[0]) if row else False
+
+    async def log_message(self, user_id: int, content: str):
+        if not await self.is_opted_in(user_id):
+            return
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute("INSERT INTO learned_messages (user_id, content) VALUES (?, ?)", (user_id, content))
+            await db.commit()
+
+
+class InlineWriteDatabase(DatabaseManager):
+    """Pooled connection, but one INSERT and commit per message inside on_message."""
+
+    async def log_message(self, user_id: int, content: str):
+        if not await self.is_opted_in(user_id):
+            return
+        await self.db.execute("INSERT INTO learned_messages (user_id, content) VALUES (?, ?)", (user_id, content))
+        await self.db.commit()
+
+
+async def simulate_on_message(db, messages):
+    """The database work on_message does for each incoming message."""
+    for user_id, content in messages:
+        if await db.is_opted_in(user_id):
+            await db.log_message(user_id, content)
+
+
+async def bench_db(args):
+    rng = random.Random(args.seed)
+    users = list(range(1, args.users + 1))
+    opted_in = set(rng.sample(users, int(len(users) * args.opt_in_ratio)))
+    messages = [(rng.choice(users), random_text(rng)) for _ in range(args.messages)]
+
+    print(f"Per-message DB overhead: {args.messages} messages, {args.users} users, "
+          f"{len(opted_in)} opted in")
+    variants = (
+        ("connect per call", ConnectPerCallDatabase),
+        ("pooled, inline writes", InlineWriteDatabase),
+        ("pooled, write-behind", DatabaseManager),
+    )
+    for label, cls in variants:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = cls(os.path.join(tmp, "bench.db"))
+            await db.initialize()
+            for user_id in opted_in:
+                await db.set_opt_in(user_id, True)
+            start = time.perf_counter()
+            await simulate_on_message(db, messages)
+            handler_time = time.perf_counter() - start
+            # Time until everything is durable, so the write-behind numbers are honest
+            await db.flush()
+            report(label, len(messages), handler_time)
+            report("  incl. final flush", len(messages), time.perf_counter() - start)
+            await db.close()
+
+
+def fill_corpus(path, rows, hole_ratio=0.1):
+    """Bulk-load `rows` learned messages straight through sqlite3, then punch random holes."""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA cache_size=-262144")
+    conn.execute("""
+        WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq WHERE x < ?)
+        INSERT INTO learned_messages (user_id, content)
+        SELECT x % 200, 'learned message number ' || x FROM seq
+    """, (rows,))
+    # Deletes leave gaps in the id range, which is the hard case for rowid sampling
+    conn.execute("DELETE FROM learned_messages WHERE abs(random()) % 1000 < ?", (int(hole_ratio * 1000),))
+    conn.commit()
+    conn.close()
+
+
+async def wait_for_backfill(db):
+    """Let the startup hash/embedding backfill finish, so it doesn't share the connection with timed queries."""
+    for corpus in db._corpora:
+        if corpus._backfill_task is not None:
+            await corpus._backfill_task
+
+
+async def time_queries(fn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        await fn()
+    return (time.perf_counter() - start) / repeats
+
+
+async def bench_sample(args):
+    print(f"Random context sampling, limit={args.limit}, {int(args.hole_ratio * 100)}% of ids deleted")
+    print(f"{'rows':>10} {'ORDER BY RANDOM()':>20} {'rowid sampling':>16}")
+    for rows in [int(r) for r in args.rows.split(",")]:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            db = DatabaseManager(path)
+            await db.initialize()
+            await db.close()
+            fill_corpus(path, rows, args.hole_ratio)
+            await db.initialize()
+            await wait_for_backfill(db)
+
+            legacy_repeats = max(1, min(args.repeats, 2_000_000 // rows))
+            legacy = await time_queries(lambda: db._shared._sample_by_sort(args.limit), legacy_repeats)
+            sampled = await time_queries(lambda: db.get_random_learned_messages(args.limit), args.repeats)
+            print(f"{rows:>10} {legacy * 1e3:>17.2f} ms {sampled * 1e3:>13.3f} ms")
+            await db.close()
+
+    # Uniformity: every row of a small corpus should be drawn about equally often
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        db = DatabaseManager(path)
+        await db.initialize()
+        await db.close()
+        fill_corpus(path, 1000, args.hole_ratio)
+        await db.initialize()
+        await wait_for_backfill(db)
+        counts = collections.Counter()
+        draws = 20000
+        for _ in range(draws):
+            sample = await db.get_random_learned_messages(args.limit)
+            assert len(sample) == len(set(sample)), "duplicate within a sample"
+            counts.update(sample)
+        rows = db.message_count()
+        expected = draws * args.limit / rows
+        chi2 = sum((counts[content] - expected) ** 2 / expected for content in counts)
+        chi2 += (rows - len(counts)) * expected
+        print(f"uniformity over {rows} rows: chi^2={chi2:.0f} for {rows - 1} degrees of freedom")
+        await db.close()
+
+
+async def legacy_stats(db):
+    """The full-table aggregation /stats used to run on every call."""
+    async with db.db.execute("SELECT COUNT(*) FROM user_prefs WHERE opt_in = 1") as c:
+        opted_in = (await c.fetchone())[0]
+    async with db.db.execute("SELECT COUNT(*) FROM learned_messages") as c:
+        total = (await c.fetchone())[0]
+    async with db.db.execute("""
+        SELECT user_id, COUNT(*) AS msg_count FROM learned_messages
+        GROUP BY user_id ORDER BY msg_count DESC, user_id LIMIT 3
+    """) as c:
+        top = await c.fetchall()
+    return opted_in, total, top
+
+
+async def bench_stats(args):
+    """/stats from user_stats vs the aggregate queries; tests/test_stats.py checks they agree."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        # Fill before the first initialize() so the user_stats backfill is exercised too
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE learned_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, "
+                     "content TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
+        conn.commit()
+        conn.close()
+        fill_corpus(path, args.rows)
+        db = DatabaseManager(path)
+        start = time.perf_counter()
+        await db.initialize()
+        print(f"initialize() incl. user_stats backfill of {args.rows} rows: {(time.perf_counter() - start) * 1e3:.0f} ms")
+        await wait_for_backfill(db)
+        for user_id in range(0, 200, 2):
+            await db.set_opt_in(user_id, True)
+
+        legacy = await time_queries(lambda: legacy_stats(db), max(1, min(args.repeats, 20_000_000 // args.rows)))
+        summary = await time_queries(db.get_stats, args.repeats)
+        print(f"/stats aggregate queries {legacy * 1e3:>10.2f} ms")
+        print(f"/stats from user_stats   {summary * 1e3:>10.3f} ms")
+        await db.close()
+
+
+async def bench_guilds(args):
+    """Ingest into many guilds at once, then sample per guild, with one shared file and with a file per guild."""
+    rng = random.Random(args.seed)
+    # Zipf-like sizes: a few big guilds and a long tail of small ones
+    weights = [1 / (rank + 1) for rank in range(args.guilds)]
+    guilds = rng.choices(range(1, args.guilds + 1), weights=weights, k=args.messages)
+    messages = [(rng.randrange(1, 201), random_text(rng), guild_id) for guild_id in guilds]
+    print(f"{args.messages} messages over {args.guilds} guilds (largest {guilds.count(1)}, "
+          f"smallest {guilds.count(args.guilds)})")
+    for label, per_guild in (("shared file", False), ("file per guild", True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = DatabaseManager(os.path.join(tmp, "bench.db"), batch_size=1000,
+                                 guild_db_dir=os.path.join(tmp, "guilds") if per_guild else None)
+            await db.initialize()
+            await wait_for_backfill(db)
+            for user_id in range(1, 201):
+                await db.set_opt_in(user_id, True)
+            start = time.perf_counter()
+            for user_id, content, guild_id in messages:
+                await db.log_message(user_id, content, guild_id)
+            await db.flush()
+            report(f"{label}: ingest", len(messages), time.perf_counter() - start)
+            for guild_id in (1, args.guilds):
+                elapsed = await time_queries(lambda: db.get_random_learned_messages(args.limit, guild_id), args.repeats)
+                print(f"{label}: sample guild {guild_id:<3} {elapsed * 1e3:>9.3f} ms")
+            problems = await db.verify_stats()
+            print(f"{label}: consistency {'ok' if not problems else '; '.join(problems)}")
+            await db.close()
+
+
+REACTIONS = ["lol", "LOL", "lmao", "xd", "real", "true", "😭", "💀", "fr", "no way", "W", "L"]
+
+
+def chat_stream(rng, count, pastas=30):
+    """Synthetic chat: mostly unique lines, plus reactions, reposted copypasta and lightly edited copies."""
+    copypasta = [random_text(rng, 25, 60) for _ in range(pastas)]
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.15:
+            yield rng.choice(REACTIONS)
+        elif roll < 0.25:
+            yield rng.choice(copypasta)
+        elif roll < 0.30:
+            words = rng.choice(copypasta).split()
+            words[rng.randrange(len(words))] = random_text(rng, 1, 1)
+            yield " ".join(words) + rng.choice(["", "!!", " lol"])
+        else:
+            yield random_text(rng, 3, 20)
+
+
+async def bench_dedup(args):
+    rng = random.Random(args.seed)
+    messages = list(chat_stream(rng, args.messages))
+    raw_bytes = sum(len(m.encode("utf-8")) for m in messages)
+    print(f"{args.messages} synthetic chat messages, {raw_bytes / 1024:.0f} KiB, threshold {args.threshold}")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, "bench.db"), dedup_threshold=args.threshold,
+                             retention_max_rows=args.max_rows or None)
+        await db.initialize()
+        await db.set_opt_in(1, True)
+        for content in messages:
+            await db.log_message(1, content, guild_id=1)
+        await db.flush()
+        hist = metrics.histograms[("dedup_seconds", ())]
+        stats = db.dedup.stats
+        print(f"dedup stage            {hist.sum / args.messages * 1e6:>8.1f} us/msg "
+              f"(batch p99 {hist.quantile(0.99) * 1e3:.1f} ms)")
+        print(f"stored                 {db.message_count(1):>8} rows")
+        print(f"dropped exact          {stats['exact']:>8}")
+        print(f"dropped near           {stats['near']:>8}")
+        print(f"saved                  {stats['bytes_saved'] / 1024:>8.0f} KiB, ~{stats['tokens_saved']} prompt tokens")
+        problems = await db.verify_stats()
+        print(f"consistency            {'ok' if not problems else '; '.join(problems)}")
+        await db.close()
+
+
+def legacy_prompt(context_messages, history, user_message):
+    """The layout generate_response used before PromptBuilder: variable sections inside the system prompt, no budget."""
+    vibe = "\n".join(f"- {msg}" for msg in context_messages)
+    system = f"\n{IDENTITY}\n\n{VIBE_HEADER}\n{vibe}\n\n{HISTORY_HEADER}\n" + "\n".join(history) + f"\n\n{INSTRUCTIONS}\n"
+    return [{"role": "system", "content": system}, {"role": "user", "content": request_text(user_message)}]
+
+
+async def bench_prompt(args):
+    """Time to first token against a stub that charges for uncached prompt tokens, old layout vs PromptBuilder."""
+    rng = random.Random(args.seed)
+    pool = [random_text(rng, 3, 20) for _ in range(2000)]
+    channels = [[f"user{rng.randrange(50)}: {random_text(rng)}" for _ in range(10)] for _ in range(args.channels)]
+    requests = []
+    for _ in range(args.requests):
+        history = rng.choice(channels)
+        history.append(f"user{rng.randrange(50)}: {random_text(rng)}")
+        del history[0]
+        long_message = rng.random() < args.long_ratio
+        trigger = random_text(rng, 2000, 4000) if long_message else random_text(rng)
+        requests.append((rng.sample(pool, 15), list(history), trigger))
+    print(f"{args.requests} replies over {args.channels} channels, {args.long_ratio:.0%} with very long triggers; "
+          f"stub {args.first_token_ms:g} ms + {args.prompt_token_ms:g} ms per uncached prompt token")
+
+    builder = PromptBuilder(num_ctx=args.num_ctx)
+    layouts = (("old layout", legacy_prompt),
+               ("prompt builder", lambda vibe, history, trigger: builder.build(vibe, history, trigger)))
+    for label, build in layouts:
+        stub = StubOllama(first_token_delay=args.first_token_ms / 1000, token_delay=0.001,
+                          prompt_token_delay=args.prompt_token_ms / 1000)
+        client = OllamaClient(host=await stub.start(), max_concurrency=1)
+        model = label.replace(" ", "-")
+        overflows = 0
+        for vibe, history, trigger in requests:
+            messages = build(vibe, history, trigger)
+            if sum(estimate_tokens(m["content"]) for m in messages) + builder.reply_tokens > args.num_ctx:
+                overflows += 1
+            await client.chat(model, messages, options=builder.options, stream=True, stop_after_sentences=2)
+        hist = metrics.histograms[("llm_time_to_first_token_seconds", (("model", model),))]
+        cached = stub.stats["cached_prompt_tokens"] / stub.stats["prompt_tokens"]
+        print(f"{label:<16} ttft mean {hist.sum / hist.count * 1e3:7.1f} ms  max {hist.max * 1e3:7.1f} ms  "
+              f"prompt {stub.stats['prompt_tokens'] / args.requests:6.0f} tok/reply, {cached:4.0%} cached  "
+              f"over num_ctx {overflows}")
+        await client.close()
+        await stub.stop()
+    print(f"prompts trimmed by the builder: {builder.stats['trimmed']}")
+
+
+TEXT_MODEL, VISION_MODEL = "llama3.2:3b", "llava"
+
+
+async def pool_requests(pool, args, rng, midway=None):
+    """Send text and vision requests at args.rate per second; returns latencies per model and the error count."""
+    latencies = {TEXT_MODEL: [], VISION_MODEL: []}
+    errors = 0
+
+    async def one(model):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            if model == VISION_MODEL:
+                await pool.chat(model, [{"role": "user", "content": "describe this"}])
+            else:
+                await pool.chat(model, [{"role": "user", "content": random_text(rng)}],
+                                stream=True, stop_after_sentences=2)
+        except Exception:
+            errors += 1
+            return
+        latencies[model].append(time.perf_counter() - start)
+
+    tasks = []
+    for n in range(args.requests):
+        if n == args.requests // 2 and midway is not None:
+            await midway()
+        tasks.append(asyncio.create_task(one(VISION_MODEL if rng.random() < args.vision_ratio else TEXT_MODEL)))
+        await asyncio.sleep(rng.expovariate(args.rate))
+    await asyncio.gather(*tasks)
+    return latencies, errors
+
+
+def report_pool(label, latencies, errors):
+    for model, values in latencies.items():
+        print(f"{label:<22} {model:<12} p50 {percentile(values, 50) * 1e3:7.0f} ms  "
+              f"p95 {percentile(values, 95) * 1e3:7.0f} ms  ({len(values)} ok, {errors} errors overall)")
+
+
+async def bench_pool(args):
+    """One Ollama server swapping llama3.2 and llava, vs a pool with the models on separate stub servers."""
+    rng = random.Random(args.seed)
+
+    def make_stub():
+        return StubOllama(first_token_delay=args.first_token_ms / 1000, token_delay=args.token_ms / 1000,
+                          load_delay=args.load_ms / 1000, max_loaded=1)
+
+    print(f"{args.requests} requests at {args.rate:g}/s, {args.vision_ratio:.0%} vision; stub servers hold one model "
+          f"at a time and take {args.load_ms:g} ms to load one")
+
+    single = make_stub()
+    pool = OllamaPool([OllamaEndpoint(OllamaClient(await single.start(), args.concurrency))])
+    await pool.warm([TEXT_MODEL, VISION_MODEL])
+    report_pool("one server", *await pool_requests(pool, args, rng))
+    print(f"{'':<22} model loads: {single.stats['loads']}")
+    await pool.close()
+    await single.stop()
+
+    stubs = [make_stub() for _ in range(3)]
+    tags = [[TEXT_MODEL], [TEXT_MODEL], [VISION_MODEL]]
+    urls = [await stub.start() for stub in stubs]
+    pool = OllamaPool([OllamaEndpoint(OllamaClient(url, args.concurrency), models) for url, models in zip(urls, tags)],
+                      probe_interval=args.probe_interval)
+    pool.start()
+    await pool.warm()
+    report_pool("pool", *await pool_requests(pool, args, rng))
+
+    def served():
+        return ", ".join(f"{url.rsplit(':', 1)[1]} {sorted({r['model'] for r in stub.requests})} "
+                         f"{len(stub.requests)} req" for url, stub in zip(urls, stubs))
+    print(f"{'':<22} {served()}; model loads: {sum(stub.stats['loads'] for stub in stubs)}")
+
+    # Take a text server down halfway through, then bring it back on the same port
+    port = int(urls[0].rsplit(":", 1)[1])
+    for stub in stubs:
+        stub.requests.clear()
+    report_pool("pool, server down", *await pool_requests(pool, args, rng, midway=stubs[0].stop))
+    print(f"{'':<22} {served()}")
+    print(f"{'':<22} failovers {pool.stats['failovers']}, ejections {pool.stats['ejections']}, "
+          f"healthy {pool.healthy_count}/{len(stubs)}")
+    stubs[0] = make_stub()
+    await stubs[0].start(port=port)
+    start = time.perf_counter()
+    while pool.healthy_count < len(stubs) and time.perf_counter() - start < args.probe_interval * 10:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.2)  # Let the re-warm finish
+    print(f"{'':<22} back after {time.perf_counter() - start:.2f}s, reloaded {sorted(stubs[0].loaded)}")
+    for stub in stubs:
+        stub.requests.clear()
+    report_pool("pool, server back", *await pool_requests(pool, args, rng))
+    print(f"{'':<22} {served()}")
+    await pool.close()
+    for stub in stubs:
+        await stub.stop()
+
+
+async def bench_retrieval(args):
+    rng = np.random.default_rng(args.seed)
+    embedder = HashingEmbedder(dim=args.dim)
+    index = EmbeddingIndex(args.dim)
+    chunk = 100_000
+    start = time.perf_counter()
+    for offset in range(0, args.rows, chunk):
+        n = min(chunk, args.rows - offset)
+        vectors = normalize(rng.standard_normal((n, args.dim), dtype=np.float32))
+        index.add(np.arange(offset + 1, offset + n + 1), vectors)
+    print(f"Embedding index: {args.rows} x {args.dim} float32 "
+          f"({index.nbytes / 2**20:.0f} MiB), built in {time.perf_counter() - start:.1f}s")
+
+    py_rng = random.Random(args.seed)
+    queries = [random_text(py_rng) for _ in range(args.repeats)]
+    start = time.perf_counter()
+    query_vectors = [(await embedder.embed([q]))[0] for q in queries]
+    embed_time = (time.perf_counter() - start) / len(queries)
+
+    latencies = []
+    for vector in query_vectors:
+        t = time.perf_counter()
+        index.search(vector, args.k)
+        latencies.append(time.perf_counter() - t)
+    latencies.sort()
+    print(f"query embedding (hashing)  {embed_time * 1e3:8.3f} ms")
+    print(f"top-{args.k} search p50          {latencies[len(latencies) // 2] * 1e3:8.2f} ms")
+    print(f"top-{args.k} search p95          {latencies[int(len(latencies) * 0.95)] * 1e3:8.2f} ms")
+
+
+# --- pipeline: fake Discord objects ---------------------------------------
+
+PARTNER_BOT_ID = 1336477279110561802
+_snowflakes = itertools.count(1_000_000)
+
+
+class FakeUser:
+    def __init__(self, user_id, name, bot=False):
+        self.id = user_id
+        self.name = name
+        self.bot = bot
+
+    def mentioned_in(self, message):
+        return self in message.mentions
+
+
+class FakeAttachment:
+    def __init__(self, url, size):
+        self.url = url
+        self.size = size
+        self.filename = url.rsplit("/", 1)[-1]
+        self.content_type = "image/png"
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeChannel:
+    def __init__(self, channel_id, stages, history_delay, send_delay, guild=None):
+        self.id = channel_id
+        self.guild = guild
+        self.stages = stages
+        self.history_delay = history_delay
+        self.send_delay = send_delay
+        self.sent = []
+
+    async def history(self, limit=100):
+        # One REST round trip, like discord.py fetching a page of history
+        with self.stages.time("history fetch"):
+            await asyncio.sleep(self.history_delay)
+        author = FakeUser(1, "someone")
+        for i in range(limit):
+            yield FakeMessage(self, author, f"older message {i}", message_id=limit - i)
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+    async def send(self, content):
+        with self.stages.time("send"):
+            await asyncio.sleep(self.send_delay)
+        self.sent.append(content)
+
+
+class FakeMessage:
+    _state = None  # Read by commands.Context
+
+    def __init__(self, channel, author, content, mentions=(), attachments=(), message_id=None):
+        self.id = message_id or next(_snowflakes)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.clean_content = content
+        self.mentions = list(mentions)
+        self.mention_everyone = False
+        self.attachments = list(attachments)
+
+    async def reply(self, content):
+        await self.channel.send(content)
+
+
+class StageTimes:
+    """Wall time per pipeline stage. Stages overlap across concurrent messages."""
+
+    def __init__(self):
+        self.totals = collections.defaultdict(float)
+        self.calls = collections.Counter()
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[stage] += time.perf_counter() - start
+            self.calls[stage] += 1
+
+    def wrap(self, obj, attr, stage):
+        original = getattr(obj, attr)
+
+        @functools.wraps(original)
+        async def timed(*args, **kwargs):
+            with self.time(stage):
+                return await original(*args, **kwargs)
+        setattr(obj, attr, timed)
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def start_image_server(payload, delay):
+    async def handle(request):
+        await asyncio.sleep(delay)
+        return web.Response(body=payload, content_type="image/png")
+    runner = web.AppRunner(web.Application())
+    runner.app.router.add_get("/{name}", handle)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+
+REGRESSION_PROFILE = {
+    "rate": 50.0, "messages": 2000, "users": 100, "channels": 20, "guilds": 4,
+    "opt_in_ratio": 0.5, "mention_ratio": 0.05, "bot_ratio": 0.01, "attachment_ratio": 0.03,
+    "image_repeat_ratio": 0.5, "response_chance": 0.05, "first_token_ms": 200.0, "token_ms": 10.0,
+    "history_ms": 150.0, "image_ms": 50.0, "send_ms": 50.0, "seed": 1,
+}
+
+
+async def bench_pipeline(args):
+    if args.profile == "regression":
+        for key, value in REGRESSION_PROFILE.items():
+            setattr(args, key, value)
+    rng = random.Random(args.seed)
+    random.seed(args.seed)  # should_trigger uses the global generator
+
+    stub = StubOllama(first_token_delay=args.first_token_ms / 1000, token_delay=args.token_ms / 1000)
+    ollama_url = await stub.start()
+    images = []
+    for i in range(8):
+        buf = io.BytesIO()
+        Image.new("RGB", (1280, 720), (i * 30, 80, 160)).save(buf, "PNG")
+        images.append(buf.getvalue())
+    image_runner, image_url = await start_image_server(images[0], args.image_ms / 1000)
+
+    # bot.py reads its configuration at import time
+    os.environ["OLLAMA_HOST"] = ollama_url
+    os.environ.setdefault("BOT_OWNER_ID", "1")
+    os.environ["RESPONSE_CHANCE"] = str(args.response_chance)
+    logging.getLogger("discord").setLevel(logging.ERROR)
+    import bot as bot_module
+    logging.getLogger().setLevel(logging.WARNING)
+
+    tmp = tempfile.TemporaryDirectory()
+    bench_bot = bot_module.LearningBot(db_path=os.path.join(tmp.name, "bench.db"))
+    bench_bot._connection.user = FakeUser(999, "Shady", bot=True)
+    await bench_bot.start_services()
+
+    stages = StageTimes()
+    stages.wrap(bench_bot.db, "log_message", "db")
+    stages.wrap(bench_bot.db, "get_relevant_learned_messages", "db")
+    stages.wrap(bench_bot.images, "fetch_all", "image download")
+    stages.wrap(bench_bot.brain, "generate_response", "llm")
+
+    users = [FakeUser(i, f"user{i}") for i in range(1, args.users + 1)]
+    for user in rng.sample(users, int(len(users) * args.opt_in_ratio)):
+        await bench_bot.db.set_opt_in(user.id, True)
+    partner = FakeUser(PARTNER_BOT_ID, "miku", bot=True)
+    await bench_bot.db.set_opt_in(partner.id, True)
+    guilds = [FakeGuild(i) for i in range(1, args.guilds + 1)]
+    channels = [FakeChannel(i, stages, args.history_ms / 1000, args.send_ms / 1000, guilds[i % len(guilds)])
+                for i in range(1, args.channels + 1)]
+
+    sent_at = {}
+    reply_latencies = []
+    handler_latencies = []
+    respond = bench_bot.respond
+
+    async def timed_respond(job):
+        already_sent = len(job.message.channel.sent)
+        await respond(job)
+        if len(job.message.channel.sent) > already_sent:
+            reply_latencies.append(time.perf_counter() - sent_at[job.message.id])
+    bench_bot.scheduler.handler = timed_respond
+
+    async def dispatch(message):
+        start = time.perf_counter()
+        await bench_bot.on_message(message)
+        handler_latencies.append(time.perf_counter() - start)
+
+    print(f"Pipeline: {args.messages} messages at {args.rate:g} msg/s over {args.channels} channels, "
+          f"stub LLM {args.first_token_ms:g} ms + {args.token_ms:g} ms/token")
+    tasks = []
+    start = time.perf_counter()
+    for n in range(args.messages):
+        channel = rng.choice(channels)
+        author = partner if rng.random() < args.bot_ratio else rng.choice(users)
+        mentions = [bench_bot.user] if rng.random() < args.mention_ratio else []
+        attachments = []
+        if rng.random() < args.attachment_ratio:
+            name = "repost.png" if rng.random() < args.image_repeat_ratio else f"img{n}.png"
+            attachments = [FakeAttachment(f"{image_url}/{name}", len(images[0]))]
+        message = FakeMessage(channel, author, random_text(rng), mentions, attachments)
+        sent_at[message.id] = time.perf_counter()
+        # discord.py dispatches every gateway event as its own task
+        tasks.append(asyncio.create_task(dispatch(message)))
+        await asyncio.sleep(rng.expovariate(args.rate))
+    await asyncio.gather(*tasks)
+    ingest_time = time.perf_counter() - start
+
+    # Let queued replies finish
+    while bench_bot.scheduler.depth or bench_bot.brain.client.in_flight or bench_bot.brain.client.waiting:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.2)
+    await bench_bot.db.flush()
+    total_time = time.perf_counter() - start
+
+    scheduler = bench_bot.scheduler.stats
+    print(f"throughput          {args.messages / ingest_time:10.1f} msg/s offered, "
+          f"{len(handler_latencies) / sum(handler_latencies):,.0f} msg/s on_message capacity "
+          f"({total_time:.1f}s until the last reply)")
+    print(f"on_message latency  p50 {percentile(handler_latencies, 50) * 1e3:8.2f} ms  "
+          f"p95 {percentile(handler_latencies, 95) * 1e3:8.2f} ms  p99 {percentile(handler_latencies, 99) * 1e3:8.2f} ms")
+    print(f"end-to-end reply    p50 {percentile(reply_latencies, 50) * 1e3:8.0f} ms  "
+          f"p95 {percentile(reply_latencies, 95) * 1e3:8.0f} ms  p99 {percentile(reply_latencies, 99) * 1e3:8.0f} ms  "
+          f"({len(reply_latencies)} replies)")
+    print(f"scheduler           submitted={sum(scheduler['submitted'].values())} "
+          f"coalesced={scheduler['coalesced']} dropped={sum(scheduler['dropped'].values())} "
+          f"expired={sum(scheduler['expired'].values())}")
+    print("stage breakdown (summed wall time, overlapping across messages):")
+    for stage in ("db", "history fetch", "image download", "llm", "send"):
+        calls = stages.calls[stage]
+        mean = stages.totals[stage] / calls * 1e3 if calls else 0.0
+        print(f"  {stage:<16} {stages.totals[stage]:8.2f} s  {calls:6d} calls  {mean:8.2f} ms/call")
+
+    await bench_bot.stop_services()
+    await image_runner.cleanup()
+    await stub.stop()
+    tmp.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    db_parser = sub.add_parser("db", help="per-message database overhead in on_message")
+    db_parser.add_argument("--messages", type=int, default=5000)
+    db_parser.add_argument("--users", type=int, default=200)
+    db_parser.add_argument("--opt-in-ratio", type=float, default=0.5)
+    db_parser.add_argument("--seed", type=int, default=1)
+    db_parser.set_defaults(func=bench_db)
+
+    sample_parser = sub.add_parser("sample", help="random context sampling at several corpus sizes")
+    sample_parser.add_argument("--rows", default="10000,1000000,10000000",
+                               help="comma-separated corpus sizes")
+    sample_parser.add_argument("--limit", type=int, default=15)
+    sample_parser.add_argument("--repeats", type=int, default=200)
+    sample_parser.add_argument("--hole-ratio", type=float, default=0.1)
+    sample_parser.set_defaults(func=bench_sample)
+
+    retrieval_parser = sub.add_parser("retrieval", help="embedding search latency over a large corpus")
+    retrieval_parser.add_argument("--rows", type=int, default=1_000_000)
+    retrieval_parser.add_argument("--dim", type=int, default=128)
+    retrieval_parser.add_argument("--k", type=int, default=10)
+    retrieval_parser.add_argument("--repeats", type=int, default=100)
+    retrieval_parser.add_argument("--seed", type=int, default=1)
+    retrieval_parser.set_defaults(func=bench_retrieval)
+
+    stats_parser = sub.add_parser("stats", help="/stats cost with and without the summary table")
+    stats_parser.add_argument("--rows", type=int, default=1_000_000)
+    stats_parser.add_argument("--repeats", type=int, default=200)
+    stats_parser.set_defaults(func=bench_stats)
+
+    guilds_parser = sub.add_parser("guilds", help="per-guild ingestion and sampling, shared file vs file per guild")
+    guilds_parser.add_argument("--guilds", type=int, default=20)
+    guilds_parser.add_argument("--messages", type=int, default=200_000)
+    guilds_parser.add_argument("--limit", type=int, default=15)
+    guilds_parser.add_argument("--repeats", type=int, default=200)
+    guilds_parser.add_argument("--seed", type=int, default=1)
+    guilds_parser.set_defaults(func=bench_guilds)
+
+    dedup_parser = sub.add_parser("dedup", help="ingest-time duplicate filtering cost and savings")
+    dedup_parser.add_argument("--messages", type=int, default=20_000)
+    dedup_parser.add_argument("--threshold", type=float, default=0.8)
+    dedup_parser.add_argument("--max-rows", type=int, default=0, help="per-guild corpus cap (0 for none)")
+    dedup_parser.add_argument("--seed", type=int, default=1)
+    dedup_parser.set_defaults(func=bench_dedup)
+
+    prompt_parser = sub.add_parser("prompt", help="time to first token with the old and the cache-friendly prompt layout")
+    prompt_parser.add_argument("--requests", type=int, default=200)
+    prompt_parser.add_argument("--channels", type=int, default=10)
+    prompt_parser.add_argument("--long-ratio", type=float, default=0.03, help="share of triggers that are huge pastes")
+    prompt_parser.add_argument("--num-ctx", type=int, default=4096)
+    prompt_parser.add_argument("--first-token-ms", type=float, default=20.0)
+    prompt_parser.add_argument("--prompt-token-ms", type=float, default=0.25)
+    prompt_parser.add_argument("--seed", type=int, default=1)
+    prompt_parser.set_defaults(func=bench_prompt)
+
+    pool_parser = sub.add_parser("pool", help="routing, failover and recovery across several Ollama stub servers")
+    pool_parser.add_argument("--requests", type=int, default=200)
+    pool_parser.add_argument("--rate", type=float, default=5.0, help="requests per second")
+    pool_parser.add_argument("--vision-ratio", type=float, default=0.2)
+    pool_parser.add_argument("--concurrency", type=int, default=2, help="requests in flight per server")
+    pool_parser.add_argument("--load-ms", type=float, default=1000.0)
+    pool_parser.add_argument("--first-token-ms", type=float, default=100.0)
+    pool_parser.add_argument("--token-ms", type=float, default=5.0)
+    pool_parser.add_argument("--probe-interval", type=float, default=0.5)
+    pool_parser.add_argument("--seed", type=int, default=1)
+    pool_parser.set_defaults(func=bench_pool)
+
+    pipeline_parser = sub.add_parser("pipeline", help="end-to-end on_message throughput and latency")
+    pipeline_parser.add_argument("--profile", choices=["regression"],
+                                 help="fixed settings to compare releases; overrides the options below")
+    pipeline_parser.add_argument("--rate", type=float, default=50.0, help="messages per second")
+    pipeline_parser.add_argument("--messages", type=int, default=2000)
+    pipeline_parser.add_argument("--users", type=int, default=100)
+    pipeline_parser.add_argument("--channels", type=int, default=20)
+    pipeline_parser.add_argument("--guilds", type=int, default=4)
+    pipeline_parser.add_argument("--opt-in-ratio", type=float, default=0.5)
+    pipeline_parser.add_argument("--mention-ratio", type=float, default=0.05)
+    pipeline_parser.add_argument("--bot-ratio", type=float, default=0.01)
+    pipeline_parser.add_argument("--attachment-ratio", type=float, default=0.03)
+    pipeline_parser.add_argument("--image-repeat-ratio", type=float, default=0.5,
+                                 help="share of images that are reposts of the same file")
+    pipeline_parser.add_argument("--response-chance", type=float, default=0.05)
+    pipeline_parser.add_argument("--first-token-ms", type=float, default=200.0)
+    pipeline_parser.add_argument("--token-ms", type=float, default=10.0)
+    pipeline_parser.add_argument("--history-ms", type=float, default=150.0, help="simulated REST latency")
+    pipeline_parser.add_argument("--image-ms", type=float, default=50.0)
+    pipeline_parser.add_argument("--send-ms", type=float, default=50.0)
+    pipeline_parser.add_argument("--seed", type=int, default=1)
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
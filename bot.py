@@ -5,10 +5,17 @@ import os
 from dotenv import load_dotenv
 import logging
 import asyncio
-from database import DatabaseManager
+from database import DatabaseManager, normalize_timestamp
 from brain import BotBrain
+from llm import OllamaPool, parse_hosts, parse_keep_alive
+from retrieval import HashingEmbedder, OllamaEmbedder
+from history import ChannelHistory
+from scheduler import Priority, ResponseScheduler
+from images import ImageFetcher, VisionCache
+from metrics import metrics, start_metrics_server
 import aiohttp
-import base64
+import io
+import time
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -20,32 +27,205 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 RESPONSE_CHANCE = float(os.getenv("RESPONSE_CHANCE", 0.05))
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.2:3b")
 BOT_OWNER_ID = int(os.getenv("BOT_OWNER_ID"))  # Replace with actual owner ID
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")  # e.g. nomic-embed-text, or "hashing" for the offline embedder; unset samples randomly
+RETRIEVAL_RANDOM_RATIO = float(os.getenv("RETRIEVAL_RANDOM_RATIO", 0.3))
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", 2))  # Per Ollama server
+# Ollama servers and the models each keeps loaded, e.g. "http://gpu1:11434=llama3.2:3b;http://gpu2:11434=llava";
+# unset uses OLLAMA_HOST alone
+OLLAMA_HOSTS = parse_hosts(os.getenv("OLLAMA_HOSTS", "")) or [(None, None)]
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", 120))
+OLLAMA_STREAM = os.getenv("OLLAMA_STREAM", "1") == "1"
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", 4096))  # Context window in tokens; prompts are trimmed to fit
+OLLAMA_KEEP_ALIVE = parse_keep_alive(os.getenv("OLLAMA_KEEP_ALIVE", "30m"))  # How long models stay loaded between requests; -1 for forever
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 1024 * 1024))
+VISION_CACHE_TTL_HOURS = float(os.getenv("VISION_CACHE_TTL_HOURS", 168))
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))  # Serve Prometheus metrics on localhost when set
+RESPONSE_QUEUE_DEPTH = int(os.getenv("RESPONSE_QUEUE_DEPTH", 20))
+HISTORY_LENGTH = 10  # Previous messages given to the model as conversation context
+HISTORY_MAX_CHANNELS = int(os.getenv("HISTORY_MAX_CHANNELS", 1000))
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", 8 * 1024 * 1024))
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", 0))  # Forget learned messages older than this; 0 keeps them
+RETENTION_MAX_ROWS = int(os.getenv("RETENTION_MAX_ROWS", 0))  # Keep at most this many learned messages per server; 0 for no cap
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.8))  # Similarity at which a message counts as a repeat; 1 for exact only, 0 off
+GUILD_DB_DIR = os.getenv("GUILD_DB_DIR")  # Store each server's learned messages in its own file in this directory
+LEGACY_GUILD_ID = int(os.getenv("LEGACY_GUILD_ID", 0))  # Server that messages learned before the upgrade belong to
+
+def guild_id(source):
+    """Guild of a message or interaction; direct messages are filed under 0."""
+    return source.guild.id if source.guild else 0
 
 class LearningBot(commands.Bot):
-    def __init__(self):
+    def __init__(self, db_path="bot_data.db"):
         intents = discord.Intents.default()
         intents.message_content = True  # Required to read messages for learning
         super().__init__(command_prefix="!", intents=intents)
         
-        self.db = DatabaseManager()
-        self.brain = BotBrain(model=OLLAMA_MODEL)
+        embedder = None  # Context is a random sample of learned messages
+        if EMBEDDING_MODEL == "hashing":
+            embedder = HashingEmbedder()
+        elif EMBEDDING_MODEL:
+            embedder = OllamaEmbedder(EMBEDDING_MODEL)
+        self.db = DatabaseManager(
+            db_path,
+            embedder=embedder,
+            retention_days=RETENTION_DAYS,
+            retention_max_rows=RETENTION_MAX_ROWS,
+            guild_db_dir=GUILD_DB_DIR,
+            legacy_guild_id=LEGACY_GUILD_ID,
+            dedup_threshold=DEDUP_THRESHOLD,
+        )
+        self.brain = BotBrain(
+            model=OLLAMA_MODEL,
+            client=OllamaPool.from_hosts(OLLAMA_HOSTS, max_concurrency=OLLAMA_MAX_CONCURRENCY, timeout=OLLAMA_TIMEOUT),
+            stream=OLLAMA_STREAM,
+            vision_cache=VisionCache(db=self.db, ttl=VISION_CACHE_TTL_HOURS * 3600),
+            num_ctx=OLLAMA_NUM_CTX,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+        )
+        # +1 because the triggering message is buffered too
+        self.history = ChannelHistory(
+            per_channel=HISTORY_LENGTH + 1,
+            max_channels=HISTORY_MAX_CHANNELS,
+            max_bytes=HISTORY_MAX_BYTES,
+        )
+        # One worker per Ollama slot; the rest wait in priority order
+        self.scheduler = ResponseScheduler(
+            self.respond,
+            workers=self.brain.client.max_concurrency,
+            max_depth=RESPONSE_QUEUE_DEPTH,
+        )
+        # Created in setup_hook, once there is a running event loop
+        self.http_session = None
+        self.images = None
+        self.metrics_runner = None
+        # Long-running owner jobs (e.g. deletions); kept so they aren't garbage collected
+        self.background_jobs = set()
         self.response_chance = RESPONSE_CHANCE
         self.vision_enabled = True  # Will be loaded from DB
 
     async def setup_hook(self):
+        await self.start_services()
+        # Load the models now rather than on the first reply
+        await self.brain.warm(vision=self.vision_enabled)
+        # Sync slash commands
+        await self.tree.sync()
+        logger.info(f"Bot setup complete. Vision: {'enabled' if self.vision_enabled else 'disabled'}. Slash commands synced.")
+
+    async def start_services(self):
+        """Start everything on_message depends on. Needs a running loop but no Discord connection."""
         # Initialize database
         await self.db.initialize()
         # Load vision setting
         self.vision_enabled = await self.db.get_vision_enabled()
-        # Sync slash commands
-        await self.tree.sync()
-        logger.info(f"Bot setup complete. Vision: {'enabled' if self.vision_enabled else 'disabled'}. Slash commands synced.")
+        # One pooled session for all attachment downloads
+        self.http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=30, sock_connect=5),
+        )
+        self.images = ImageFetcher(self.http_session, max_bytes=IMAGE_MAX_BYTES)
+        self.brain.client.start()
+        self.scheduler.start()
+        self._register_gauges()
+        if METRICS_PORT:
+            self.metrics_runner = await start_metrics_server(METRICS_PORT)
+
+    def _register_gauges(self):
+        metrics.gauge("response_queue_depth", lambda: self.scheduler.depth)
+        metrics.gauge("ingest_queue_depth", lambda: self.db.queue_depth)
+        metrics.gauge("ingest_backpressure_waits", lambda: self.db.ingest_stats["backpressure_waits"])
+        metrics.gauge("ollama_in_flight", lambda: self.brain.client.in_flight)
+        metrics.gauge("ollama_waiting", lambda: self.brain.client.waiting)
+        metrics.gauge("ollama_healthy_endpoints", lambda: self.brain.client.healthy_count)
+        metrics.gauge("history_channels", lambda: len(self.history))
+        metrics.gauge("history_bytes", lambda: self.history.nbytes)
+        metrics.gauge("embedding_index_size", lambda: self.db.embedding_count)
+        if self.db.dedup is not None:
+            dedup = self.db.dedup.stats
+            metrics.gauge("dedup_exact_dropped", lambda: dedup["exact"])
+            metrics.gauge("dedup_near_dropped", lambda: dedup["near"])
+            metrics.gauge("dedup_bytes_saved", lambda: dedup["bytes_saved"])
+            metrics.gauge("dedup_prompt_tokens_saved", lambda: dedup["tokens_saved"])
+            metrics.gauge("dedup_window_bytes", lambda: self.db.dedup.nbytes)
+        metrics.gauge("prompts_trimmed", lambda: self.brain.prompts.stats["trimmed"])
+        metrics.gauge("vision_cache_hit_rate", lambda: self.brain.vision_cache.hit_rate)
+        metrics.gauge("image_fetch_errors", lambda: self.images.stats["errors"])
+
+    async def close(self):
+        await super().close()
+        await self.stop_services()
+
+    async def stop_services(self):
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        # Deletions commit batch by batch, so stopping one part-way is safe
+        for job in self.background_jobs:
+            job.cancel()
+        await asyncio.gather(*self.background_jobs, return_exceptions=True)
+        await self.scheduler.stop()
+        await self.brain.close()
+        if self.http_session is not None:
+            await self.http_session.close()
+        # Close the database last so in-flight handlers can finish their writes
+        await self.db.close()
+
+    def start_deletion(self, interaction, description, delete):
+        """
+        Run `delete(progress=...)` in the background, reporting progress to the
+        (already deferred) interaction through a followup that is edited as
+        batches complete.
+        """
+        job = asyncio.create_task(self._run_deletion(interaction, description, delete))
+        self.background_jobs.add(job)
+        job.add_done_callback(self.background_jobs.discard)
+
+    async def _run_deletion(self, interaction, description, delete, update_every=2.0):
+        try:
+            status = await interaction.followup.send(f"🧹 Deleting {description}...", ephemeral=True, wait=True)
+        except discord.HTTPException as e:
+            # Deleting doesn't depend on the status message, so carry on without it
+            logger.warning(f"Could not send deletion status: {e}")
+            status = None
+        last_update = time.monotonic()
+
+        async def progress(deleted):
+            nonlocal last_update
+            if status is None or time.monotonic() - last_update < update_every:
+                return
+            last_update = time.monotonic()
+            try:
+                await status.edit(content=f"🧹 Deleting {description}... {deleted} so far")
+            except discord.HTTPException as e:
+                logger.warning(f"Could not update deletion progress: {e}")
+
+        try:
+            count = await delete(progress=progress)
+        except Exception as e:
+            logger.exception(f"Error deleting {description}")
+            result = f"❌ Error deleting {description}: {e}"
+        else:
+            result = f"🧹 Deleted {count} {description}!"
+        if status is None:
+            return
+        try:
+            await status.edit(content=result)
+        except discord.HTTPException as e:
+            # e.g. the interaction token expired during a long deletion
+            logger.warning(f"Could not report deletion result ({result}): {e}")
 
     async def on_ready(self):
         logger.info(f"Logged in as {self.user} (ID: {self.user.id})")
         logger.info("------")
 
     async def on_message(self, message):
+        with metrics.timer("on_message_seconds"):
+            await self._handle_message(message)
+        # Process prefix commands (if any)
+        await self.process_commands(message)
+
+    async def _handle_message(self, message):
+        # Buffer every message, ours included, so replies have context without a REST call
+        self.history.add(message.channel.id, message.id, message.author.name, message.clean_content)
+
         # Don't respond to ourselves
         if message.author == self.user:
             return
@@ -56,73 +236,109 @@ class LearningBot(commands.Bot):
             # Clean up message (strip pings etc maybe)
             content = message.clean_content
             if content.strip():
-                await self.db.log_message(message.author.id, content)
+                await self.db.log_message(
+                    message.author.id, content, guild_id=guild_id(message), channel_id=message.channel.id
+                )
                 # logger.info(f"Learned from {message.author.name}")
 
         is_mentioned = self.user.mentioned_in(message) and not message.mention_everyone
         is_other_bot = message.author.id == 1336477279110561802  # Respond to miku
         random_roll = self.brain.should_trigger(self.response_chance)
         
-        # Check for images (only if user is opted in and vision is enabled)
-        images = []
+        # Check for images (only if user is opted in and vision is enabled).
+        # They're downloaded by the response worker, so shed jobs cost nothing.
+        # Images Discord reports as too large would be skipped there, so they don't count.
+        attachments = []
         if is_opted_in and self.vision_enabled and message.attachments:
-            for attachment in message.attachments:
-                if attachment.content_type and attachment.content_type.startswith('image/'):
-                    try:
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(attachment.url) as resp:
-                                if resp.status == 200:
-                                    image_data = await resp.read()
-                                    # Limit to 1MB to avoid issues
-                                    if len(image_data) <= 1024 * 1024:
-                                        b64_image = base64.b64encode(image_data).decode('utf-8')
-                                        images.append(b64_image)
-                                    else:
-                                        logger.warning(f"Image too large from {message.author.name}: {len(image_data)} bytes")
-                    except Exception as e:
-                        logger.error(f"Error downloading image: {e}")
+            attachments = [
+                a for a in message.attachments
+                if a.content_type and a.content_type.startswith('image/') and not (a.size and a.size > IMAGE_MAX_BYTES)
+            ]
+
+        # Most important reason first; the scheduler serves mentions before random rolls
+        if is_mentioned:
+            priority = Priority.MENTION
+        elif is_other_bot:
+            priority = Priority.BOT
+        elif attachments:
+            priority = Priority.VISION
+        elif random_roll:
+            priority = Priority.RANDOM
+        else:
+            priority = None
+
+        if priority is not None:
+            metrics.inc("triggers_total", type=priority.name.lower())
+            await self.scheduler.submit(message.channel.id, priority, message, attachments)
+
+    async def respond(self, job):
+        """Generate and send one reply for a scheduled job."""
+        started = time.perf_counter()
+        message = job.message
+        images = []
+        if job.attachments:
+            with metrics.timer("response_stage_seconds", stage="images"):
+                images = await self.images.fetch_all(job.attachments)
+        if job.priority == Priority.VISION and not images:
+            # The images were the only reason to reply, and none could be used
+            metrics.inc("errors_total", source="no_images")
+            return
+
+        with metrics.timer("response_stage_seconds", stage="context"):
+            context = await self.db.get_relevant_learned_messages(
+                message.clean_content, limit=15, random_ratio=RETRIEVAL_RANDOM_RATIO, guild_id=guild_id(message)
+            )
         
-        # Combine them into one clear variable
-        should_respond = is_mentioned or is_other_bot or random_roll or (len(images) > 0 and is_opted_in and self.vision_enabled)
-
-        if should_respond:
-            context = await self.db.get_random_learned_messages(limit=15)
-            
-            # Fetch recent history for more context
-            history = []
+        # Recent history for more context, from the buffer unless this
+        # channel hasn't been watched long enough since startup
+        if self.history.needs_backfill(message.channel.id):
             try:
-                # Fetch last 10 messages, excluding the current one
-                async for msg in message.channel.history(limit=11):
-                    if msg.id == message.id:
-                        continue
-                    # Format as "[Username]: [Message]"
-                    history.append(f"{msg.author.name}: {msg.clean_content}")
-                
-                # Reverse to get chronological order (top to bottom)
-                history.reverse()
+                with metrics.timer("response_stage_seconds", stage="history_fetch"):
+                    entries = [
+                        (msg.id, msg.author.name, msg.clean_content)
+                        async for msg in message.channel.history(limit=HISTORY_LENGTH + 1)
+                    ]
+                self.history.backfill(message.channel.id, entries)
             except Exception as e:
+                metrics.inc("errors_total", source="history_fetch")
                 logger.error(f"Error fetching history: {e}")
+        # Formatted as "[Username]: [Message]", oldest first, excluding the current one
+        history = self.history.recent(message.channel.id, limit=HISTORY_LENGTH, exclude=message.id)
 
-            if context:
-                async with message.channel.typing():
+        if context:
+            async with message.channel.typing():
+                with metrics.timer("response_stage_seconds", stage="llm"):
                     response = await self.brain.generate_response(
                         context, 
                         conversation_history=history,
                         user_message=message.clean_content,
                         images=images if images else None
                     )
+                
+                if response:
+                    response = response.strip().strip('"').strip("'")
                     
-                    if response:
-                        response = response.strip().strip('"').strip("'")
-                        
-                        # Use the logic from earlier to decide how to send it
-                        if is_mentioned:
+                    # Reply directly when someone pinged us
+                    with metrics.timer("response_stage_seconds", stage="send"):
+                        if job.priority == Priority.MENTION:
                             await message.reply(response)
                         else:
                             await message.channel.send(response)
+                    metrics.observe("response_seconds", time.perf_counter() - started)
+                else:
+                    metrics.inc("errors_total", source="empty_response")
 
-        # Process prefix commands (if any)
-        await self.process_commands(message)
+    async def on_raw_message_edit(self, payload):
+        self.history.edit(payload.channel_id, payload.message_id, payload.message.clean_content)
+
+    async def on_raw_message_delete(self, payload):
+        self.history.delete(payload.channel_id, [payload.message_id])
+
+    async def on_raw_bulk_message_delete(self, payload):
+        self.history.delete(payload.channel_id, payload.message_ids)
+
+    async def on_guild_channel_delete(self, channel):
+        self.history.forget_channel(channel.id)
 
 bot = LearningBot()
 
@@ -145,7 +361,8 @@ async def privacy_status(interaction: discord.Interaction):
 
 @bot.tree.command(name="stats", description="Show bot learning statistics")
 async def stats(interaction: discord.Interaction):
-    opted_in, total_msgs, top_users = await bot.db.get_stats()
+    # Memory and leaderboard are per server; learning opt-in is global
+    opted_in, total_msgs, top_users = await bot.db.get_stats(guild_id=guild_id(interaction))
     embed = discord.Embed(
         title="🧠 Brain Statistics",
         color=discord.Color.blue()
@@ -157,41 +374,110 @@ async def stats(interaction: discord.Interaction):
     embed.description = f"**Top stupid morons of all time I've learned from:**\n{leaderboard_text}"
     embed.add_field(name="Opted-in Users", value=f"👤 `{opted_in}`", inline=True)
     embed.add_field(name="Total Memory", value=f"💬 `{total_msgs}`", inline=True)
+    embed.add_field(name="All Servers", value=f"🌐 `{bot.db.message_count()}`", inline=True)
+    vision_cache = bot.brain.vision_cache
+    embed.add_field(
+        name="Vision Cache",
+        value=f"🖼️ `{vision_cache.hit_rate:.0%} hits` · `{vision_cache.saved_seconds:.0f}s saved`",
+        inline=True,
+    )
     embed.set_footer(text=f"Requested by {interaction.user.name}")
     await interaction.response.send_message(embed=embed)
 
+@bot.tree.command(name="perf", description="Show performance counters and latency histograms (owner only)")
+async def perf(interaction: discord.Interaction):
+    # Check if user is bot owner
+    if interaction.user.id != BOT_OWNER_ID:
+        await interaction.response.send_message("❌ You need to be the bot owner to use this command.", ephemeral=True)
+        return
+
+    lines = [metrics.render_text()]
+    # Generation speed per model, from the token counters Ollama reports
+    for (name, labels), tokens in metrics.counters.items():
+        if name == "llm_eval_tokens_total":
+            seconds = metrics.counters.get(("llm_eval_seconds_total", labels), 0)
+            if seconds:
+                lines.append(f"tokens_per_second[{dict(labels)['model']}] {tokens / seconds:.1f}")
+    scheduler = bot.scheduler.stats
+    lines.append(f"scheduler dropped={scheduler['dropped']} expired={scheduler['expired']} coalesced={scheduler['coalesced']}")
+    report = "\n".join(lines) or "No data yet."
+
+    if len(report) > 1900:
+        await interaction.response.send_message(
+            "📈 Performance report", file=discord.File(io.BytesIO(report.encode()), "perf.txt"), ephemeral=True
+        )
+    else:
+        await interaction.response.send_message(f"📈 Performance report\n```\n{report}\n```", ephemeral=True)
+
 @bot.tree.command(name="clear_all_messages", description="⚠️ Delete ALL learned messages (owner only)")
-async def clear_all_messages(interaction: discord.Interaction):
+@app_commands.describe(server_only="Only delete messages learned in this server")
+async def clear_all_messages(interaction: discord.Interaction, server_only: bool = False):
     # Check if user is bot owner
     if interaction.user.id != BOT_OWNER_ID:
         await interaction.response.send_message("❌ You need to be the bot owner to use this command.", ephemeral=True)
         return
     
-    await bot.db.clear_all_messages()
-    await interaction.response.send_message("🧹 All learned messages have been cleared!", ephemeral=True)
+    scope = guild_id(interaction) if server_only else None
+    await interaction.response.defer(ephemeral=True)
+    bot.start_deletion(interaction, "learned messages" + (" from this server" if server_only else ""),
+                       lambda progress: bot.db.clear_all_messages(progress=progress, guild_id=scope))
+
+@bot.tree.command(name="remove_duplicates", description="Delete stored messages that repeat a newer one (owner only)")
+@app_commands.describe(server_only="Only delete duplicates learned in this server")
+async def remove_duplicates(interaction: discord.Interaction, server_only: bool = False):
+    # Check if user is bot owner
+    if interaction.user.id != BOT_OWNER_ID:
+        await interaction.response.send_message("❌ You need to be the bot owner to use this command.", ephemeral=True)
+        return
+
+    scope = guild_id(interaction) if server_only else None
+    await interaction.response.defer(ephemeral=True)
+    bot.start_deletion(interaction, "duplicate learned messages" + (" from this server" if server_only else ""),
+                       lambda progress: bot.db.remove_duplicate_messages(progress=progress, guild_id=scope))
 
 @bot.tree.command(name="clear_messages_before", description="⚠️ Delete messages before a specific date (owner only)")
-@app_commands.describe(timestamp="Timestamp in format: YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
-async def clear_messages_before(interaction: discord.Interaction, timestamp: str):
+@app_commands.describe(
+    timestamp="UTC timestamp in format: YYYY-MM-DD or YYYY-MM-DD HH:MM:SS",
+    server_only="Only delete messages learned in this server",
+)
+async def clear_messages_before(interaction: discord.Interaction, timestamp: str, server_only: bool = False):
     # Check if user is bot owner
     if interaction.user.id != BOT_OWNER_ID:
         await interaction.response.send_message("❌ You need to be the bot owner to use this command.", ephemeral=True)
         return
     
-    count = await bot.db.clear_messages_before(timestamp)
-    await interaction.response.send_message(f"🧹 Deleted {count} messages from before {timestamp}!", ephemeral=True)
+    try:
+        timestamp = normalize_timestamp(timestamp)
+    except ValueError:
+        await interaction.response.send_message("❌ Invalid timestamp. Use YYYY-MM-DD or YYYY-MM-DD HH:MM:SS (UTC).", ephemeral=True)
+        return
+    scope = guild_id(interaction) if server_only else None
+    await interaction.response.defer(ephemeral=True)
+    bot.start_deletion(interaction, f"messages from before {timestamp}" + (" in this server" if server_only else ""),
+                       lambda progress: bot.db.clear_messages_before(timestamp, progress=progress, guild_id=scope))
 
 @bot.tree.command(name="clear_messages_after", description="⚠️ Delete messages after a specific date (owner only)")
-@app_commands.describe(timestamp="Timestamp in format: YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
-async def clear_messages_after(interaction: discord.Interaction, timestamp: str):
+@app_commands.describe(
+    timestamp="UTC timestamp in format: YYYY-MM-DD or YYYY-MM-DD HH:MM:SS",
+    server_only="Only delete messages learned in this server",
+)
+async def clear_messages_after(interaction: discord.Interaction, timestamp: str, server_only: bool = False):
     # Check if user is bot owner
     if interaction.user.id != BOT_OWNER_ID:
         await interaction.response.send_message("❌ You need to be the bot owner to use this command.", ephemeral=True)
         return
     
-    count = await bot.db.clear_messages_after(timestamp)
-    await interaction.response.send_message(f"🧹 Deleted {count} messages from after {timestamp}!", ephemeral=True)
-@bot.tree.command(name="pull_vision_model", description="Pull the LLaVA vision model for image analysis (owner only)")
+    try:
+        timestamp = normalize_timestamp(timestamp)
+    except ValueError:
+        await interaction.response.send_message("❌ Invalid timestamp. Use YYYY-MM-DD or YYYY-MM-DD HH:MM:SS (UTC).", ephemeral=True)
+        return
+    scope = guild_id(interaction) if server_only else None
+    await interaction.response.defer(ephemeral=True)
+    bot.start_deletion(interaction, f"messages from after {timestamp}" + (" in this server" if server_only else ""),
+                       lambda progress: bot.db.clear_messages_after(timestamp, progress=progress, guild_id=scope))
+
+@bot.tree.command(name="pull_vision_model", description="Pull the vision model for image analysis (owner only)")
 async def pull_vision_model(interaction: discord.Interaction):
     # Check if user is bot owner
     if interaction.user.id != BOT_OWNER_ID:
@@ -199,12 +485,12 @@ async def pull_vision_model(interaction: discord.Interaction):
         return
     
     await interaction.response.defer()
+    model = bot.brain.vision_model
     try:
-        import ollama
-        await interaction.followup.send("🔄 Pulling LLaVA model... This may take a while.")
-        # Run in thread to avoid blocking
-        await asyncio.to_thread(ollama.pull, "llava")
-        await interaction.followup.send("✅ LLaVA model pulled successfully!")
+        await interaction.followup.send(f"🔄 Pulling {model}... This may take a while.")
+        # Pulled on the servers that handle vision requests, not the default host
+        hosts = await bot.brain.client.pull(model)
+        await interaction.followup.send(f"✅ {model} pulled successfully on {', '.join(hosts)}!")
     except Exception as e:
         await interaction.followup.send(f"❌ Error pulling model: {e}")
 @bot.tree.command(name="toggle_vision", description="Toggle image vision processing on/off (owner only)")
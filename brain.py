@@ -1,83 +1,108 @@
-import ollama
-import random
 import asyncio
+import logging
+import random
+import time
+
+from images import image_key
+from llm import OllamaError, OllamaPool
+from metrics import metrics
+from prompt import PromptBuilder, estimate_tokens
+
+DESCRIBE_PROMPT = (
+    "Describe this image in 2-3 plain sentences: what is in it, any visible text, "
+    "and anything funny or notable about it. Do not add commentary."
+)
+
+logger = logging.getLogger(__name__)
 
 class BotBrain:
-    def __init__(self, model="llama3.2"):
+    def __init__(self, model="llama3.2", client=None, stream=True, max_sentences=2,
+                 vision_model="llava", vision_cache=None, num_ctx=4096, keep_alive=None):
         self.model = model
+        # An llm.OllamaPool; by default just the server in OLLAMA_HOST
+        self.client = client or OllamaPool.from_hosts([(None, None)])
+        self.prompts = PromptBuilder(num_ctx=num_ctx)
+        # How long Ollama keeps the models loaded after a request (None for its default)
+        self.keep_alive = keep_alive
+        self.vision_model = vision_model
+        # Descriptions of recently seen images (images.VisionCache), so reposts skip LLaVA
+        self.vision_cache = vision_cache
+        # Streaming lets us hang up once the reply has max_sentences sentences
+        self.stream = stream
+        self.max_sentences = max_sentences
+
+    async def close(self):
+        await self.client.close()
+
+    async def warm(self, vision=True):
+        """Load the models on the Ollama servers before the first reply needs them."""
+        models = [self.model, self.vision_model] if vision else [self.model]
+        # Same num_ctx as the replies, or the first one would reload the model
+        await self.client.warm(models, keep_alive=self.keep_alive, options={self.model: self.prompts.options})
 
     async def generate_response(self, context_messages, conversation_history=None, user_message=None, images=None):
         """
         Generates a response based on learned messages and recent conversation history.
         If user_message is provided, it acts as a trigger/topic.
-        If images are provided, uses vision model to analyze them.
+        If images are provided, the vision model describes them (or the description
+        is taken from the cache) and the text model responds to the description.
         """
+        image_descriptions = []
+        if images:
+            image_descriptions = await asyncio.gather(*(self.describe_image(image) for image in images))
+            image_descriptions = [d for d in image_descriptions if d]
+            if not image_descriptions:
+                return None
         
-        # Build the learned vibe context
-        learned_vibe = "\n".join([f"- {msg}" for msg in context_messages])
-        
-        # Build the recent conversation history context
-        history_str = ""
-        if conversation_history:
-            history_str = "\n".join(conversation_history)
-        
-        # Determine if we need vision capabilities
-        use_vision = images is not None and len(images) > 0
-        model_to_use = "llava" if use_vision else self.model
-        
-        system_prompt = f"""
-You are a funny, slightly chaotic Discord bot named Shady. 
-You were created by: iota (vorlie#614807913302851594)
-CRITICAL: Never mention yourself by name. Never use the word "Shady" or "@Shady". Always speak from your own perspective. 
-Do not act like an AI, act like a regular person in the chat.
-NEVER REFER TO YOURSELF AS "SHADY", "THE BOT", "I AM SHADY", OR ANY VARIATION. You are just a person chatting.
-FORBIDDEN WORDS/PHRASES: "I'm here", "I can help", "let me know", "I'm", "I am", "I can", "I will", "my skills", "I think", "I feel" when referring to yourself.
-
---- LEARNED VIBE (Sentences you've learned from users) ---
-{learned_vibe}
+        messages = self.prompts.build(
+            context_messages,
+            conversation_history=conversation_history,
+            user_message=user_message,
+            image_descriptions=image_descriptions,
+        )
+        metrics.inc("llm_prompt_tokens_total", sum(estimate_tokens(m['content']) for m in messages), model=self.model)
 
---- RECENT CONVERSATION (What just happened in chat) ---
-{history_str}
-
---- YOUR INSTRUCTIONS ---
-Your goal is to send a short, funny message that is LOGICALLY RELEVANT to the RECENT CONVERSATION while adopting the "vibe" of the LEARNED messages.
-Your response must make sense in context. Do not just blurt out random phrases. 
-If someone asks a question, try to answer it in a funny/chaotic way instead of ignoring it.
-Keep it short (1-2 sentences). 
-Do not use emojis unless the learned messages use them.
-Do not use quotation marks around your response.
-NEVER START YOUR MESSAGE WITH "Shady:" or "@Shady:".
-ABSOLUTELY FORBIDDEN: Do not end your message with any reference to yourself, your name, or sign off as "Shady".
-RESPONSE STYLE: Speak as if you are just another user in the chat. No self-promotion, no offers of help, no "I'm here for you" type statements.
-"""
+        try:
+            return await self.client.chat(
+                self.model,
+                messages,
+                options=self.prompts.options,
+                keep_alive=self.keep_alive,
+                stream=self.stream,
+                stop_after_sentences=self.max_sentences if self.stream else None,
+            )
+        except OllamaError as e:
+            logger.error(f"Error calling Ollama: {e}")
+            return None
+        except Exception:
+            logger.exception("Unexpected error generating a reply")
+            return None
 
-        if use_vision:
-            # For vision, create a user message with images
-            prompt = f"Describe the attached image(s) and respond to this message in a funny way: '{user_message or 'Check out this image!'}'. Reflect the vibe of what you've learned. REMINDER: Do not mention yourself or 'Shady' in the reply."
-            messages = [
-                {'role': 'system', 'content': system_prompt},
-                {'role': 'user', 'content': prompt, 'images': images}
-            ]
-        else:
-            prompt = "Say something funny based on what you've learned and the current conversation. Remember: NEVER MENTION YOUR NAME."
-            if user_message:
-                prompt = f"Someone just said: '{user_message}'. Respond to it in a funny way, reflecting the vibe of what you've learned. REMINDER: Do not mention yourself or 'Shady' in the reply."
-            messages = [
-                {'role': 'system', 'content': system_prompt},
-                {'role': 'user', 'content': prompt},
-            ]
+    async def describe_image(self, image):
+        """Describe one base64 image with the vision model, reusing a cached description when possible."""
+        key = image_key(image)
+        if self.vision_cache is not None:
+            description = await self.vision_cache.get(key)
+            if description is not None:
+                return description
 
+        started = time.perf_counter()
         try:
-            # Run Ollama in a thread to avoid blocking the event loop
-            response = await asyncio.to_thread(
-                ollama.chat,
-                model=model_to_use,
-                messages=messages
+            description = await self.client.chat(
+                self.vision_model,
+                [{'role': 'user', 'content': DESCRIBE_PROMPT, 'images': [image]}],
+                keep_alive=self.keep_alive,
             )
-            return response['message']['content']
-        except Exception as e:
-            print(f"Error calling Ollama: {e}")
+        except OllamaError as e:
+            logger.error(f"Error describing image with {self.vision_model}: {e}")
+            return None
+        except Exception:
+            logger.exception("Unexpected error describing an image")
             return None
+        description = description.strip()
+        if description and self.vision_cache is not None:
+            await self.vision_cache.put(key, description, time.perf_counter() - started)
+        return description
 
     def should_trigger(self, base_chance=0.05):
         """
@@ -0,0 +1,750 @@
+import asyncio
+import collections
+import glob
+import json
+import logging
+import os
+import random
+
+import aiosqlite
+import numpy as np
+
+from dedup import content_hash
+from retrieval import EmbeddingIndex
+
+logger = logging.getLogger(__name__)
+
+
+async def connect(path, cache_size_kb=16384):
+    """
+    Open a long-lived connection to one of the bot's SQLite files.
+
+    aiosqlite runs a thread per connection, so connecting per query costs more
+    than the query. sqlite3 also caches prepared statements per connection, so
+    the fixed set of queries used here are only compiled once.
+    """
+    db = await aiosqlite.connect(path, cached_statements=256)
+    # Incremental auto-vacuum lets deletes hand pages back to the filesystem
+    # without a full VACUUM (see Corpus.reclaim_space).
+    async with db.execute("PRAGMA auto_vacuum") as cursor:
+        auto_vacuum = (await cursor.fetchone())[0]
+    if auto_vacuum != 2:
+        await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # On an existing file the new mode only takes effect after a VACUUM
+        logger.info(f"Enabling incremental auto-vacuum on {path}; rebuilding the file once.")
+        await db.execute("VACUUM")
+    # WAL lets reads run alongside a write and turns commits into appends
+    await db.execute("PRAGMA journal_mode=WAL")
+    # With WAL, NORMAL is still safe against corruption; it only skips the fsync per commit
+    await db.execute("PRAGMA synchronous=NORMAL")
+    # Negative cache_size is in KiB rather than pages
+    await db.execute(f"PRAGMA cache_size=-{int(cache_size_kb)}")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA busy_timeout=5000")
+    return db
+
+
+class Corpus:
+    """
+    Learned messages stored in one SQLite file, with their per-user counts and
+    embeddings.
+
+    Every row carries the guild it was learned in. By default a single Corpus
+    holds all guilds and queries filter on guild_id; with per-guild files
+    (see DatabaseManager) each guild gets its own Corpus, connection and
+    write lock. Guild 0 holds direct messages and anything learned before
+    messages were tagged with a guild.
+    """
+
+    def __init__(self, db, embedder=None, delete_batch_size=2000, write_lock=None, index_dir=None):
+        self.db = db
+        self.embedder = embedder
+        # Where the embedding indexes are memory-mapped from; None keeps them in memory
+        self.index_dir = index_dir
+        # Serialises multi-statement writes on this connection; shared with
+        # anything else that writes through it
+        self.write_lock = write_lock or asyncio.Lock()
+        # Deletes run delete_batch_size rows per transaction so ingestion can
+        # write between batches instead of waiting for one huge DELETE.
+        self.delete_batch_size = delete_batch_size
+        # Row counts and id ranges, overall and per guild, kept current by
+        # write() and delete_where() so sampling never has to scan.
+        self.row_count = 0
+        self.min_id = 1
+        self.max_id = 0
+        self.guild_counts = {}
+        self.guild_ranges = {}  # guild_id -> (min_id, max_id)
+        # Below this fraction of live ids in the id range rowid sampling
+        # needs too many probes and we fall back to ORDER BY RANDOM().
+        self.min_sample_density = 0.1
+        # Relevance retrieval is enabled by passing an embedder (see retrieval.py)
+        self.indexes = {}  # guild_id -> EmbeddingIndex
+        self._backfill_task = None
+        # Set once every row has a content_hash
+        self.hashes_ready = asyncio.Event()
+
+    async def setup(self, legacy_guild_id=None):
+        """Create or migrate the schema, then load counts and embeddings."""
+        db = self.db
+        # Table for learned messages
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS learned_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                content TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                guild_id INTEGER NOT NULL DEFAULT 0,
+                channel_id INTEGER,
+                content_hash INTEGER
+            )
+        """)
+        await self._add_guild_columns(legacy_guild_id)
+        await self._add_hash_column()
+        # Index for faster user-based lookups
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON learned_messages(user_id)")
+        # Index for timestamp if we want to fetch recent messages
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_timestamp ON learned_messages(timestamp)")
+        # Per-guild id ranges and sampling, and per-guild clears by date
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_guild_id ON learned_messages(guild_id, id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_guild_timestamp ON learned_messages(guild_id, timestamp)")
+        # Exact-duplicate lookups at ingest (see dedup.content_hash)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_guild_hash ON learned_messages(guild_id, content_hash)")
+        # Records which embedder produced the stored vectors
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS bot_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        # One float32 vector per learned message, written by the ingest path
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS message_embeddings (
+                message_id INTEGER PRIMARY KEY,
+                vector BLOB
+            )
+        """)
+        await db.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_delete_embedding
+            AFTER DELETE ON learned_messages
+            BEGIN
+                DELETE FROM message_embeddings WHERE message_id = old.id;
+            END
+        """)
+        await db.commit()
+        await self._create_user_stats()
+
+        # Summing the per-user counts reads one row per user instead of the whole corpus
+        async with db.execute("SELECT guild_id, SUM(message_count) FROM user_stats GROUP BY guild_id") as cursor:
+            self.guild_counts = {guild_id: count for guild_id, count in await cursor.fetchall() if count}
+        self.row_count = sum(self.guild_counts.values())
+        await self._refresh_ranges(self.guild_counts)
+
+        if self.embedder is not None:
+            await self._load_embeddings()
+        # Rows written from here on are embedded by write(), so the backfill stops at the current max id
+        self._backfill_task = asyncio.create_task(self._backfill(self.max_id))
+
+    async def close(self):
+        if self._backfill_task is not None:
+            # Unembedded or unhashed rows are picked up again on the next start
+            self._backfill_task.cancel()
+            try:
+                await self._backfill_task
+            except asyncio.CancelledError:
+                pass
+            self._backfill_task = None
+        if self.index_dir is not None and self.embedder is not None:
+            self._save_index_manifest()
+
+    async def _backfill(self, last_id):
+        await self._backfill_hashes()
+        self.hashes_ready.set()
+        if self.embedder is not None:
+            await self._backfill_embeddings(last_id)
+
+    async def _add_guild_columns(self, legacy_guild_id):
+        """Migrate a learned_messages table from before guild partitioning."""
+        async with self.db.execute("PRAGMA table_info(learned_messages)") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        if "guild_id" in columns:
+            return
+        # Adding columns with constant defaults doesn't rewrite the table
+        await self.db.execute("ALTER TABLE learned_messages ADD COLUMN guild_id INTEGER NOT NULL DEFAULT 0")
+        await self.db.execute("ALTER TABLE learned_messages ADD COLUMN channel_id INTEGER")
+        if legacy_guild_id:
+            # The bot used to be in one server; give its old messages to that guild
+            await self.db.execute("UPDATE learned_messages SET guild_id = ?", (legacy_guild_id,))
+        await self.db.commit()
+        logger.info(f"Tagged existing learned messages with guild {legacy_guild_id or 0}.")
+
+    async def _add_hash_column(self):
+        async with self.db.execute("PRAGMA table_info(learned_messages)") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        if "content_hash" not in columns:
+            # Filled in for existing rows by _backfill_hashes
+            await self.db.execute("ALTER TABLE learned_messages ADD COLUMN content_hash INTEGER")
+            await self.db.commit()
+
+    async def _backfill_hashes(self, chunk_size=1000):
+        """Hash messages stored before content_hash existed. Duplicates among them are kept (see remove_duplicates)."""
+        hashed = 0
+        after_id = 0
+        while True:
+            async with self.db.execute("""
+                SELECT id, content FROM learned_messages
+                WHERE id > ? AND content_hash IS NULL
+                ORDER BY id LIMIT ?
+            """, (after_id, chunk_size)) as cursor:
+                rows = await cursor.fetchall()
+            if not rows:
+                break
+            after_id = rows[-1][0]
+            async with self.write_lock:
+                await self.db.executemany(
+                    "UPDATE learned_messages SET content_hash = ? WHERE id = ?",
+                    [(content_hash(content or ""), message_id) for message_id, content in rows],
+                )
+                await self.db.commit()
+            hashed += len(rows)
+            await asyncio.sleep(0)
+        if hashed:
+            logger.info(f"Hashed {hashed} learned messages.")
+
+    async def remove_duplicates(self, guild_id=None, progress=None, window=20000):
+        """
+        Delete messages that exactly repeat a newer message of the same guild
+        (same content_hash), keeping the newest copy. Walks the id range
+        `window` ids at a time so each delete only scans its own slice.
+        """
+        await self.hashes_ready.wait()
+        condition = """id >= ? AND id < ? AND content_hash IS NOT NULL AND EXISTS (
+            SELECT 1 FROM learned_messages AS newer
+            WHERE newer.guild_id = learned_messages.guild_id
+              AND newer.content_hash = learned_messages.content_hash
+              AND newer.id > learned_messages.id
+        )"""
+        prefix = () if guild_id is None else (guild_id,)
+        if guild_id is not None:
+            condition = f"guild_id = ? AND {condition}"
+        total = 0
+        for start in range(self.min_id, self.max_id + 1, window):
+            async def report(deleted, done=total):
+                await progress(done + deleted)
+            total += await self.delete_where(condition, (*prefix, start, start + window),
+                                             report if progress else None, reclaim=False)
+            if progress is not None:
+                await progress(total)
+        if total:
+            await self.reclaim_space()
+        return total
+
+    async def existing_hashes(self, guild_id, hashes):
+        """The subset of `hashes` already stored for `guild_id`."""
+        hashes = list(hashes)
+        if not hashes:
+            return set()
+        placeholders = ",".join("?" * len(hashes))
+        async with self.db.execute(
+            f"SELECT content_hash FROM learned_messages WHERE guild_id = ? AND content_hash IN ({placeholders})",
+            (guild_id, *hashes),
+        ) as cursor:
+            return {row[0] for row in await cursor.fetchall()}
+
+    async def recent_contents(self, guild_id, limit):
+        """The guild's latest `limit` messages, oldest first."""
+        async with self.db.execute(
+            "SELECT content FROM learned_messages WHERE guild_id = ? ORDER BY id DESC LIMIT ?", (guild_id, limit)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    async def _create_user_stats(self):
+        """
+        Per-guild, per-user message counts for /stats, kept current by triggers
+        on learned_messages so every insert and delete path updates them.
+        Built from the existing corpus the first time it is created.
+        """
+        db = self.db
+        async with db.execute("PRAGMA table_info(user_stats)") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        if "guild_id" in columns:
+            return
+        # One transaction, so a crash can't leave the table created but not filled
+        await db.execute("BEGIN")
+        if columns:
+            # Counts from before guild partitioning; rebuilt per guild below
+            await db.execute("DROP TRIGGER IF EXISTS trg_user_stats_insert")
+            await db.execute("DROP TRIGGER IF EXISTS trg_user_stats_delete")
+            await db.execute("DROP TABLE user_stats")
+        await db.execute("""
+            CREATE TABLE user_stats (
+                guild_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (guild_id, user_id)
+            )
+        """)
+        # Leaderboard reads walk this index from the top
+        await db.execute("CREATE INDEX idx_user_stats_count ON user_stats(guild_id, message_count)")
+        await db.execute("""
+            INSERT INTO user_stats (guild_id, user_id, message_count)
+            SELECT guild_id, user_id, COUNT(*) FROM learned_messages
+            WHERE user_id IS NOT NULL
+            GROUP BY guild_id, user_id
+        """)
+        await db.execute("""
+            CREATE TRIGGER trg_user_stats_insert
+            AFTER INSERT ON learned_messages
+            WHEN new.user_id IS NOT NULL
+            BEGIN
+                INSERT INTO user_stats (guild_id, user_id, message_count) VALUES (new.guild_id, new.user_id, 1)
+                ON CONFLICT(guild_id, user_id) DO UPDATE SET message_count = message_count + 1;
+            END
+        """)
+        await db.execute("""
+            CREATE TRIGGER trg_user_stats_delete
+            AFTER DELETE ON learned_messages
+            WHEN old.user_id IS NOT NULL
+            BEGIN
+                UPDATE user_stats SET message_count = message_count - 1
+                WHERE guild_id = old.guild_id AND user_id = old.user_id;
+                DELETE FROM user_stats
+                WHERE guild_id = old.guild_id AND user_id = old.user_id AND message_count <= 0;
+            END
+        """)
+        await db.commit()
+        logger.info("Built per-user message counts.")
+
+    async def _refresh_ranges(self, guild_ids=()):
+        """Re-read the overall id range and those of `guild_ids`."""
+        # MIN/MAX on the rowid are single b-tree descents, not scans
+        async with self.db.execute("SELECT MIN(id), MAX(id) FROM learned_messages") as cursor:
+            low, high = await cursor.fetchone()
+        if low is None:
+            self.min_id, self.max_id = self.max_id + 1, self.max_id
+        else:
+            self.min_id, self.max_id = low, high
+        for guild_id in guild_ids:
+            if not self.guild_counts.get(guild_id):
+                self.guild_ranges.pop(guild_id, None)
+                continue
+            # Each is one descent into idx_guild_id
+            async with self.db.execute(
+                "SELECT MIN(id) FROM learned_messages WHERE guild_id = ?", (guild_id,)
+            ) as cursor:
+                low = (await cursor.fetchone())[0]
+            async with self.db.execute(
+                "SELECT MAX(id) FROM learned_messages WHERE guild_id = ?", (guild_id,)
+            ) as cursor:
+                high = (await cursor.fetchone())[0]
+            self.guild_ranges[guild_id] = (low, high)
+
+    async def write(self, rows):
+        """Insert (user_id, content, guild_id, channel_id, timestamp) rows; a None timestamp means now."""
+        async with self.write_lock:
+            previous_max_id = self.max_id
+            await self.db.executemany("""
+                INSERT INTO learned_messages (user_id, content, guild_id, channel_id, timestamp, content_hash)
+                VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?)
+            """, [(*row, content_hash(row[1])) for row in rows])
+            await self.db.commit()
+            added = collections.Counter(row[2] for row in rows)
+            for guild_id, count in added.items():
+                self.guild_counts[guild_id] = self.guild_counts.get(guild_id, 0) + count
+            self.row_count += len(rows)
+            await self._refresh_ranges(added)
+
+        if self.embedder is not None:
+            # ids only grow, so everything above the previous max id is what was just inserted
+            async with self.db.execute(
+                "SELECT id, guild_id, content FROM learned_messages WHERE id > ? ORDER BY id", (previous_max_id,)
+            ) as cursor:
+                await self._embed_rows(await cursor.fetchall())
+
+    async def _load_embeddings(self):
+        """Open the embedding indexes, discarding the stored vectors if the embedder changed."""
+        db = self.db
+        async with db.execute("SELECT value FROM bot_settings WHERE key = 'embedder'") as cursor:
+            row = await cursor.fetchone()
+        if row is None or row[0] != self.embedder.name:
+            if row is not None:
+                logger.info(f"Embedder changed from {row[0]} to {self.embedder.name}; re-embedding corpus.")
+            await db.execute("DELETE FROM message_embeddings")
+            await db.execute("""
+                INSERT INTO bot_settings (key, value)
+                VALUES ('embedder', ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            """, (self.embedder.name,))
+            await db.commit()
+
+        self.indexes = {}
+        if self.index_dir is not None:
+            os.makedirs(self.index_dir, exist_ok=True)
+            if self._open_index_files():
+                logger.info(f"Mapped {self.embedding_count} message embeddings from {self.index_dir}.")
+                return
+            for path in glob.glob(os.path.join(self.index_dir, "guild_*.npy*")):
+                os.remove(path)
+        await self._rebuild_indexes()
+        logger.info(f"Loaded {self.embedding_count} message embeddings.")
+
+    def _index_path(self, guild_id):
+        return None if self.index_dir is None else os.path.join(self.index_dir, f"guild_{guild_id}")
+
+    def _open_index_files(self):
+        """
+        Map the index files saved by the last clean shutdown. The manifest is
+        removed while the bot runs, so after a crash the files are rebuilt
+        from message_embeddings instead of trusted.
+        """
+        manifest_path = os.path.join(self.index_dir, "manifest.json")
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            os.remove(manifest_path)
+        except (OSError, ValueError):
+            return False
+        if manifest.get("embedder") != self.embedder.name:
+            return False
+        try:
+            for guild_id, size in manifest["guilds"].items():
+                self.indexes[int(guild_id)] = EmbeddingIndex.open(self._index_path(guild_id), size)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Rebuilding embedding indexes in {self.index_dir}: {e}")
+            self.indexes = {}
+            return False
+        return True
+
+    def _save_index_manifest(self):
+        for index in self.indexes.values():
+            index.flush()
+        manifest = {
+            "embedder": self.embedder.name,
+            "guilds": {str(guild_id): len(index) for guild_id, index in self.indexes.items()},
+        }
+        path = os.path.join(self.index_dir, "manifest.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{path}.tmp", path)
+
+    async def _rebuild_indexes(self, chunk_size=10000):
+        """Fill the indexes from message_embeddings, streaming a chunk of vectors at a time."""
+        async with self.db.execute("""
+            SELECT e.message_id, m.guild_id, e.vector FROM message_embeddings e
+            JOIN learned_messages m ON m.id = e.message_id
+            ORDER BY e.message_id
+        """) as cursor:
+            while True:
+                rows = await cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                by_guild = collections.defaultdict(lambda: ([], []))
+                for message_id, guild_id, vector in rows:
+                    ids, blobs = by_guild[guild_id]
+                    ids.append(message_id)
+                    blobs.append(vector)
+                for guild_id, (ids, blobs) in by_guild.items():
+                    dim = len(blobs[0]) // 4
+                    index = self.indexes.get(guild_id)
+                    if index is None:
+                        index = self.indexes[guild_id] = EmbeddingIndex(dim, path=self._index_path(guild_id))
+                    index.add(ids, np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), dim))
+
+    @property
+    def embedding_count(self):
+        return sum(len(index) for index in self.indexes.values())
+
+    async def _embed_rows(self, rows):
+        """Embed (id, guild_id, content) rows, persist the vectors and add them to the indexes. False on failure."""
+        if not rows:
+            return True
+        try:
+            vectors = await self.embedder.embed([content for _, _, content in rows])
+        except Exception as e:
+            # Rows stay unembedded and are retried by the next startup backfill
+            logger.error(f"Error embedding messages: {e}")
+            return False
+        ids = np.array([message_id for message_id, _, _ in rows])
+        guilds = np.array([guild_id for _, guild_id, _ in rows])
+        async with self.write_lock:
+            # A deletion may have removed some rows while they were being embedded;
+            # their vectors would be orphaned, so keep only the rows still there
+            async with self.db.execute(
+                "SELECT id FROM learned_messages WHERE id BETWEEN ? AND ?", (int(ids.min()), int(ids.max()))
+            ) as cursor:
+                existing = np.array([row[0] for row in await cursor.fetchall()], dtype=ids.dtype)
+            keep = np.isin(ids, existing)
+            ids, guilds, vectors = ids[keep], guilds[keep], vectors[keep]
+            await self.db.executemany(
+                "INSERT OR REPLACE INTO message_embeddings (message_id, vector) VALUES (?, ?)",
+                [(message_id, vector.tobytes()) for message_id, vector in zip(ids.tolist(), vectors)],
+            )
+            await self.db.commit()
+            # Indexed before the lock is released, so a later deletion batch removes them again
+            for guild_id in np.unique(guilds).tolist():
+                index = self.indexes.get(guild_id)
+                if index is None:
+                    index = self.indexes[guild_id] = EmbeddingIndex(vectors.shape[1], path=self._index_path(guild_id))
+                mask = guilds == guild_id
+                index.add(ids[mask], vectors[mask])
+        return True
+
+    async def _backfill_embeddings(self, up_to_id, chunk_size=256):
+        """Embed learned messages up to `up_to_id` that predate the index, a chunk at a time."""
+        total = 0
+        last_id = 0
+        while True:
+            async with self.db.execute("""
+                SELECT m.id, m.guild_id, m.content FROM learned_messages m
+                LEFT JOIN message_embeddings e ON e.message_id = m.id
+                WHERE m.id > ? AND m.id <= ? AND e.message_id IS NULL
+                ORDER BY m.id LIMIT ?
+            """, (last_id, up_to_id, chunk_size)) as cursor:
+                rows = await cursor.fetchall()
+            if not rows:
+                break
+            if not await self._embed_rows(rows):
+                break  # Embedder is failing; try again on next start
+            total += len(rows)
+            last_id = rows[-1][0]
+            await asyncio.sleep(0)
+        if total:
+            logger.info(f"Backfilled embeddings for {total} learned messages.")
+
+    async def relevant(self, query, limit, random_ratio, guild_id):
+        """
+        The learned messages of `guild_id` most similar to `query`, topped up
+        with random ones. See DatabaseManager.get_relevant_learned_messages.
+        """
+        index = self.indexes.get(guild_id)
+        if index is None or not len(index) or not query or not query.strip():
+            return await self.sample(limit, guild_id)
+
+        try:
+            query_vector = (await self.embedder.embed([query]))[0]
+        except Exception as e:
+            logger.error(f"Error embedding query: {e}")
+            return await self.sample(limit, guild_id)
+        # A full scan of the guild's matrix; off the event loop so it can't stall the gateway.
+        # Rows added or removed meanwhile can skew the ids, but they are looked up below anyway.
+        top_ids = await asyncio.to_thread(index.search, query_vector, limit - int(limit * random_ratio))
+        placeholders = ",".join("?" * len(top_ids))
+        async with self.db.execute(
+            f"SELECT id, content FROM learned_messages WHERE id IN ({placeholders})", top_ids
+        ) as cursor:
+            by_id = dict(await cursor.fetchall())
+        results = [by_id[message_id] for message_id in top_ids if message_id in by_id]
+
+        if len(results) < limit:
+            seen = set(results)
+            # Oversample a little so duplicates of the top hits can be skipped
+            for content in await self.sample(limit - len(results) + 5, guild_id):
+                if len(results) >= limit:
+                    break
+                if content not in seen:
+                    seen.add(content)
+                    results.append(content)
+        return results
+
+    async def sample(self, limit, guild_id=None):
+        """
+        Random learned messages, from one guild or from all of them.
+
+        Draws random ids from the live id range and looks them up by primary key,
+        retrying for ids that fell into gaps left by deletes (or, within a guild,
+        by other guilds' messages). Every stored message is equally likely and a
+        sample never repeats a message, like ORDER BY RANDOM(), but the cost does
+        not grow with the table.
+        """
+        if guild_id is None:
+            count, (low, high) = self.row_count, (self.min_id, self.max_id)
+            guild_filter, guild_params = "", ()
+        else:
+            count, (low, high) = self.guild_counts.get(guild_id, 0), self.guild_ranges.get(guild_id, (1, 0))
+            guild_filter, guild_params = " AND guild_id = ?", (guild_id,)
+        limit = min(limit, count)
+        if limit <= 0:
+            return []
+        span = high - low + 1
+        density = count / span if span > 0 else 0
+        if density < self.min_sample_density:
+            return await self._sample_by_sort(limit, guild_id)
+
+        found = {}
+        for _ in range(8):
+            need = limit - len(found)
+            # Oversample by the expected miss rate so one round is usually enough
+            probes = min(span, 500, int(need / density * 1.25) + 4)
+            ids = [i for i in random.sample(range(low, high + 1), probes) if i not in found]
+            placeholders = ",".join("?" * len(ids))
+            async with self.db.execute(
+                f"SELECT id, content FROM learned_messages WHERE id IN ({placeholders}){guild_filter}",
+                (*ids, *guild_params),
+            ) as cursor:
+                rows = await cursor.fetchall()
+            # Rows come back in id order; shuffle so truncating does not favour low ids
+            random.shuffle(rows)
+            for message_id, content in rows[:need]:
+                found[message_id] = content
+            if len(found) >= limit:
+                return list(found.values())
+        return await self._sample_by_sort(limit, guild_id)
+
+    async def _sample_by_sort(self, limit, guild_id=None):
+        # Within a guild this only sorts that guild's rows, found through idx_guild_id
+        guild_filter, params = ("", (limit,)) if guild_id is None else ("WHERE guild_id = ?", (guild_id, limit))
+        async with self.db.execute(f"""
+            SELECT content FROM learned_messages {guild_filter}
+            ORDER BY RANDOM() LIMIT ?
+        """, params) as cursor:
+            rows = await cursor.fetchall()
+            return [row[0] for row in rows]
+
+    async def top_contributors(self, limit, guild_id=None):
+        """(user_id, count) of the users with the most learned messages, from user_stats."""
+        if guild_id is None:
+            sql = """
+                SELECT user_id, SUM(message_count) AS total
+                FROM user_stats
+                GROUP BY user_id
+                ORDER BY total DESC, user_id
+                LIMIT ?
+            """
+            params = (limit,)
+        else:
+            sql = """
+                SELECT user_id, message_count
+                FROM user_stats
+                WHERE guild_id = ?
+                ORDER BY message_count DESC, user_id
+                LIMIT ?
+            """
+            params = (guild_id, limit)
+        async with self.db.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+    async def user_counts(self):
+        """Message count per user across every guild in this file."""
+        async with self.db.execute("SELECT user_id, SUM(message_count) FROM user_stats GROUP BY user_id") as cursor:
+            return dict(await cursor.fetchall())
+
+    async def delete_where(self, condition, params=(), progress=None, reclaim=True):
+        """
+        Delete the learned messages matching `condition`, delete_batch_size rows
+        per transaction. The write lock is released between batches so queued
+        messages keep getting written, and the row counts, id ranges and
+        embedding indexes are updated after each one. `progress`, if given, is
+        awaited with the running total after every batch.
+        """
+        total = 0
+        while True:
+            async with self.write_lock:
+                async with self.db.execute(f"""
+                    DELETE FROM learned_messages WHERE id IN (
+                        SELECT id FROM learned_messages WHERE {condition} LIMIT ?
+                    ) RETURNING id, guild_id
+                """, (*params, self.delete_batch_size)) as cursor:
+                    deleted = await cursor.fetchall()
+                await self.db.commit()
+                by_guild = collections.defaultdict(list)
+                for message_id, guild_id in deleted:
+                    by_guild[guild_id].append(message_id)
+                for guild_id, ids in by_guild.items():
+                    self.guild_counts[guild_id] -= len(ids)
+                    if not self.guild_counts[guild_id]:
+                        del self.guild_counts[guild_id]
+                self.row_count -= len(deleted)
+                await self._refresh_ranges(by_guild)
+            for guild_id, ids in by_guild.items():
+                if guild_id in self.indexes:
+                    self.indexes[guild_id].remove(ids)
+            total += len(deleted)
+            if len(deleted) < self.delete_batch_size:
+                break
+            if progress is not None:
+                await progress(total)
+            await asyncio.sleep(0)
+        if total and reclaim:
+            await self.reclaim_space()
+        return total
+
+    async def reclaim_space(self, pages_per_step=1024):
+        """Return free pages to the filesystem a step at a time, then shrink the WAL."""
+        free = None
+        while True:
+            async with self.write_lock:
+                async with self.db.execute("PRAGMA freelist_count") as cursor:
+                    remaining = (await cursor.fetchone())[0]
+                # Stop when done, or if auto_vacuum isn't incremental and nothing moves
+                if not remaining or remaining == free:
+                    break
+                free = remaining
+                async with self.db.execute(f"PRAGMA incremental_vacuum({pages_per_step})") as cursor:
+                    await cursor.fetchall()  # Each step of the statement frees one page
+            await asyncio.sleep(0)
+        async with self.write_lock:
+            async with self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cursor:
+                await cursor.fetchall()
+
+    async def trim_guild(self, guild_id, max_rows):
+        """Delete the guild's oldest messages beyond max_rows."""
+        excess = self.guild_counts.get(guild_id, 0) - max_rows
+        if excess <= 0:
+            return 0
+        # Ids grow with insertion order, so the oldest rows are the lowest ids
+        async with self.db.execute(
+            "SELECT id FROM learned_messages WHERE guild_id = ? ORDER BY id LIMIT 1 OFFSET ?",
+            (guild_id, excess),
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return 0
+        return await self.delete_where("guild_id = ? AND id < ?", (guild_id, row[0]))
+
+    async def trim_guilds(self, max_rows):
+        """Delete the oldest messages of every guild holding more than max_rows."""
+        deleted = 0
+        for guild_id in list(self.guild_counts):
+            deleted += await self.trim_guild(guild_id, max_rows)
+        return deleted
+
+    async def verify_stats(self):
+        """Recompute counts from learned_messages and list any that differ from the cached ones."""
+        problems = []
+        db = self.db
+        async with db.execute("SELECT guild_id, COUNT(*) FROM learned_messages GROUP BY guild_id") as cursor:
+            actual = dict(await cursor.fetchall())
+        if sum(actual.values()) != self.row_count:
+            problems.append(f"total messages: cached {self.row_count}, actual {sum(actual.values())}")
+        if actual != self.guild_counts:
+            problems.append(f"guild message counts: cached {self.guild_counts}, actual {actual}")
+        async with db.execute("""
+            SELECT COALESCE(a.guild_id, s.guild_id), COALESCE(a.user_id, s.user_id),
+                   a.message_count, s.message_count
+            FROM (
+                SELECT guild_id, user_id, COUNT(*) AS message_count FROM learned_messages
+                WHERE user_id IS NOT NULL GROUP BY guild_id, user_id
+            ) a
+            FULL OUTER JOIN user_stats s ON s.guild_id = a.guild_id AND s.user_id = a.user_id
+            WHERE a.message_count IS NOT s.message_count
+        """) as cursor:
+            async for guild_id, user_id, counted, stored in cursor:
+                problems.append(f"guild {guild_id} user {user_id}: stored {stored or 0}, actual {counted or 0}")
+        return problems
+
+    async def rebuild_stats(self):
+        """Recount user_stats and the cached totals from scratch."""
+        async with self.write_lock:
+            await self.db.execute("DELETE FROM user_stats")
+            await self.db.execute("""
+                INSERT INTO user_stats (guild_id, user_id, message_count)
+                SELECT guild_id, user_id, COUNT(*) FROM learned_messages
+                WHERE user_id IS NOT NULL
+                GROUP BY guild_id, user_id
+            """)
+            await self.db.commit()
+            async with self.db.execute("SELECT guild_id, COUNT(*) FROM learned_messages GROUP BY guild_id") as cursor:
+                self.guild_counts = dict(await cursor.fetchall())
+            self.row_count = sum(self.guild_counts.values())
+            self.guild_ranges.clear()
+            await self._refresh_ranges(self.guild_counts)
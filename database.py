@@ -1,142 +1,577 @@
 import aiosqlite
+import asyncio
+import collections
+import glob
 import logging
+import os
+import random
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+from corpus import Corpus, connect
+from dedup import Deduplicator, content_hash
+from metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+# Format of CURRENT_TIMESTAMP, which is what learned_messages.timestamp holds (UTC)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+GUILD_FILE_RE = re.compile(r"guild_(\d+)\.db$")
+
+
+def normalize_timestamp(value: str) -> str:
+    """
+    Parse a user-supplied date or datetime into the stored timestamp format,
+    so comparisons against learned_messages.timestamp are exact. Accepts
+    YYYY-MM-DD, YYYY-MM-DD HH:MM[:SS] and ISO 8601 (with a T or an offset;
+    offsets are converted to UTC). Raises ValueError for anything else.
+    """
+    parsed = datetime.fromisoformat(value.strip())
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime(TIMESTAMP_FORMAT)
+
+
 class DatabaseManager:
-    def __init__(self, db_path="bot_data.db"):
+    """
+    Opt-in preferences, settings and the vision cache live in db_path. Learned
+    messages are partitioned by guild (see corpus.Corpus): by default all
+    guilds share a table in db_path, and with guild_db_dir set each guild
+    gets its own SQLite file there, so busy guilds don't queue behind one
+    writer. Methods taking a guild_id use 0 for direct messages.
+    """
+
+    def __init__(self, db_path="bot_data.db", cache_size_kb=16384,
+                 batch_size=200, flush_interval=0.5, queue_size=10000,
+                 embedder=None, retention_days=None, retention_max_rows=None,
+                 retention_interval=3600, delete_batch_size=2000,
+                 guild_db_dir=None, legacy_guild_id=None,
+                 dedup_threshold=0.8, dedup_window=5000):
         self.db_path = db_path
+        self.cache_size_kb = cache_size_kb
+        self._db = None
+        # Relevance retrieval is enabled by passing an embedder (see retrieval.py)
+        self.embedder = embedder
+        self.delete_batch_size = delete_batch_size
+        self.guild_db_dir = guild_db_dir
+        # Guild that messages learned before guild partitioning are moved to
+        self.legacy_guild_id = legacy_guild_id
+        self._shared = None  # Corpus inside db_path, unless guild_db_dir is set
+        self._guild_corpora = {}  # guild_id -> Corpus, with guild_db_dir
+        self._corpus_lock = asyncio.Lock()
+        # user_ids with opt_in = 1, mirrored from user_prefs
+        self._opted_in = set()
+        self._prefs_lock = asyncio.Lock()
+        # Serialises multi-statement writes on the main connection
+        self._write_lock = asyncio.Lock()
+        # Write-behind ingestion: messages are flushed every batch_size
+        # messages or flush_interval seconds, whichever comes first.
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self._queue = None
+        self._ingest_task = None
+        self.ingest_stats = {
+            "queued": 0,
+            "written": 0,
+            "dropped_opted_out": 0,
+            "batches": 0,
+            "backpressure_waits": 0,
+            "max_depth": 0,
+            "errors": 0,
+        }
+        # Ingest-time duplicate filter (see dedup.py). A threshold of 1 or more
+        # only drops exact repeats; None turns it off.
+        self.dedup = Deduplicator(dedup_threshold, dedup_window) if dedup_threshold else None
+        # Retention policy, enforced every retention_interval seconds when set.
+        # retention_max_rows applies to each guild separately, and is also
+        # checked after every write so a busy guild can't grow far past it.
+        self.retention_days = retention_days
+        self.retention_max_rows = retention_max_rows
+        self.retention_interval = retention_interval
+        self._retention_task = None
+
+    @property
+    def db(self) -> aiosqlite.Connection:
+        """The long-lived connection to db_path opened by initialize()."""
+        if self._db is None:
+            raise RuntimeError("DatabaseManager.initialize() must be called first")
+        return self._db
 
     async def initialize(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            # Table for user preferences (opt-in/opt-out)
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS user_prefs (
-                    user_id INTEGER PRIMARY KEY,
-                    opt_in INTEGER DEFAULT 0
-                )
-            """)
-            # Table for learned messages
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS learned_messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    content TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            # Table for bot settings
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS bot_settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
-                )
-            """)
-            # Index for faster user-based lookups
-            await db.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON learned_messages(user_id)")
-            # Index for timestamp if we want to fetch recent messages
-            await db.execute("CREATE INDEX IF NOT EXISTS idx_timestamp ON learned_messages(timestamp)")
-            await db.commit()
+        # Keep one connection per file open for the lifetime of the bot
+        self._db = await connect(self.db_path, self.cache_size_kb)
+
+        db = self.db
+        # Table for user preferences (opt-in/opt-out)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS user_prefs (
+                user_id INTEGER PRIMARY KEY,
+                opt_in INTEGER DEFAULT 0
+            )
+        """)
+        # Table for bot settings
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS bot_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        # LLaVA image descriptions keyed by content hash (see images.VisionCache)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS vision_cache (
+                image_hash TEXT PRIMARY KEY,
+                description TEXT,
+                created_at REAL
+            )
+        """)
+        await db.commit()
+
+        if self.guild_db_dir is None:
+            self._shared = Corpus(db, self.embedder, self.delete_batch_size, self._write_lock,
+                                  self._index_dir(self.db_path))
+            await self._shared.setup(self.legacy_guild_id)
+        else:
+            os.makedirs(self.guild_db_dir, exist_ok=True)
+            for path in sorted(glob.glob(os.path.join(self.guild_db_dir, "guild_*.db"))):
+                match = GUILD_FILE_RE.search(path)
+                if match:
+                    await self._corpus_for(int(match.group(1)))
+            await self._split_shared_corpus()
+
+        async with db.execute("SELECT user_id FROM user_prefs WHERE opt_in = 1") as cursor:
+            self._opted_in = {row[0] for row in await cursor.fetchall()}
+
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._ingest_task = asyncio.create_task(self._ingest_loop())
+        if self.retention_days or self.retention_max_rows:
+            self._retention_task = asyncio.create_task(self._retention_loop())
+
+    async def _corpus_for(self, guild_id, create=True):
+        """The Corpus holding `guild_id`, opening (or, if `create`, creating) its file if needed."""
+        if self._shared is not None:
+            return self._shared
+        corpus = self._guild_corpora.get(guild_id)
+        if corpus is not None or not create:
+            return corpus
+        async with self._corpus_lock:
+            corpus = self._guild_corpora.get(guild_id)
+            if corpus is None:
+                path = os.path.join(self.guild_db_dir, f"guild_{guild_id}.db")
+                corpus = Corpus(await connect(path, self.cache_size_kb), self.embedder, self.delete_batch_size,
+                                index_dir=self._index_dir(path))
+                await corpus.setup()
+                self._guild_corpora[guild_id] = corpus
+        return corpus
 
+    def _index_dir(self, path):
+        """Directory next to a database file that its memory-mapped embedding indexes go in."""
+        if self.embedder is None or path == ":memory:":
+            return None
+        return f"{path}-embeddings"
+
+    @property
+    def _corpora(self):
+        return [self._shared] if self._shared is not None else list(self._guild_corpora.values())
+
+    async def _split_shared_corpus(self, batch_size=5000):
+        """
+        Move learned messages from db_path into per-guild files, for databases
+        created before guild_db_dir was set. Embeddings are recomputed by each
+        guild file's backfill.
+        """
+        db = self.db
+        async with db.execute("PRAGMA table_info(learned_messages)") as cursor:
+            columns = {row[1] for row in await cursor.fetchall()}
+        if not columns:
+            return
+        if "guild_id" in columns:
+            guild_expr, channel_expr = "guild_id", "channel_id"
+        else:
+            guild_expr, channel_expr = str(int(self.legacy_guild_id or 0)), "NULL"
+        async with db.execute(f"SELECT DISTINCT {guild_expr} FROM learned_messages") as cursor:
+            guild_ids = [row[0] for row in await cursor.fetchall()]
+
+        moved = 0
+        for guild_id in guild_ids:
+            corpus = await self._corpus_for(guild_id)
+            while True:
+                async with db.execute(f"""
+                    SELECT id, user_id, content, {guild_expr}, {channel_expr}, timestamp
+                    FROM learned_messages WHERE {guild_expr} = ? ORDER BY id LIMIT ?
+                """, (guild_id, batch_size)) as cursor:
+                    rows = await cursor.fetchall()
+                if not rows:
+                    break
+                await corpus.write([row[1:] for row in rows])
+                placeholders = ",".join("?" * len(rows))
+                await db.execute(f"DELETE FROM learned_messages WHERE id IN ({placeholders})", [row[0] for row in rows])
+                await db.commit()
+                moved += len(rows)
+        if moved:
+            logger.info(f"Moved {moved} learned messages into per-guild files in {self.guild_db_dir}.")
+
+    async def close(self):
+        """Flush queued messages and close the connections. Safe to call more than once."""
+        if self._retention_task is not None:
+            # A retention pass cut short resumes on the next one
+            self._retention_task.cancel()
+            try:
+                await self._retention_task
+            except asyncio.CancelledError:
+                pass
+            self._retention_task = None
+        if self._ingest_task is not None:
+            # The sentinel is queued behind every pending message, so the
+            # loop writes all of them before it exits.
+            await self._queue.put(None)
+            await self._ingest_task
+            self._ingest_task = None
+        for corpus in self._corpora:
+            await corpus.close()
+            if corpus.db is not self._db:
+                await corpus.db.close()
+        self._shared = None
+        self._guild_corpora = {}
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    @metrics.timed("db_query_seconds", query="set_opt_in")
     async def set_opt_in(self, user_id: int, status: bool):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
+        # Write through: the cache only changes once the row is committed, and
+        # the lock keeps concurrent toggles from leaving the two out of order.
+        async with self._prefs_lock:
+            await self.db.execute("""
                 INSERT INTO user_prefs (user_id, opt_in)
                 VALUES (?, ?)
                 ON CONFLICT(user_id) DO UPDATE SET opt_in = excluded.opt_in
             """, (user_id, 1 if status else 0))
-            await db.commit()
+            await self.db.commit()
+            if status:
+                self._opted_in.add(user_id)
+            else:
+                self._opted_in.discard(user_id)
 
     async def is_opted_in(self, user_id: int) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("SELECT opt_in FROM user_prefs WHERE user_id = ?", (user_id,)) as cursor:
-                row = await cursor.fetchone()
-                return bool(row[0]) if row else False
+        """Answered from the in-memory cache loaded at initialize(); no I/O."""
+        return user_id in self._opted_in
 
-    async def log_message(self, user_id: int, content: str):
+    @metrics.timed("db_query_seconds", query="log_message")
+    async def log_message(self, user_id: int, content: str, guild_id: int = 0, channel_id: int = None):
+        """Queue a message for the background writer. Only waits when the queue is full."""
         # Double check opt-in before logging (privacy first)
         if not await self.is_opted_in(user_id):
             return
 
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                INSERT INTO learned_messages (user_id, content)
-                VALUES (?, ?)
-            """, (user_id, content))
-            await db.commit()
-
-    async def get_random_learned_messages(self, limit=20):
-        """Fetch random messages to provide as 'context' for the personality."""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("""
-                SELECT content FROM learned_messages 
-                ORDER BY RANDOM() LIMIT ?
-            """, (limit,)) as cursor:
-                rows = await cursor.fetchall()
-                return [row[0] for row in rows]
-
-    async def get_stats(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            # Get total stats
-            async with db.execute("SELECT COUNT(*) FROM user_prefs WHERE opt_in = 1") as c:
-                opted_in_count = (await c.fetchone())[0]
-            async with db.execute("SELECT COUNT(*) FROM learned_messages") as c:
-                total_messages = (await c.fetchone())[0]
-
-            # Get top 3 contributors (returns user_id and count)
-            async with db.execute("""
-                SELECT user_id, COUNT(*) as msg_count 
-                FROM learned_messages 
-                GROUP BY user_id 
-                ORDER BY msg_count DESC 
-                LIMIT 3
-            """) as cursor:
-                top_contributors = await cursor.fetchall()
-                
-            return opted_in_count, total_messages, top_contributors
-
-    async def clear_all_messages(self):
-        """Delete all learned messages from the database."""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("DELETE FROM learned_messages")
-            await db.commit()
-            logger.info("All learned messages have been cleared.")
-
-    async def clear_messages_before(self, timestamp: str) -> int:
+        item = (user_id, content, guild_id, channel_id, None)
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # Backpressure: the writer is behind, so make the caller wait for room
+            self.ingest_stats["backpressure_waits"] += 1
+            await self._queue.put(item)
+        self.ingest_stats["queued"] += 1
+        self.ingest_stats["max_depth"] = max(self.ingest_stats["max_depth"], self._queue.qsize())
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def flush(self):
+        """Wait until every queued message has been written."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _ingest_loop(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                self._queue.task_done()
+                break
+            batch = [first]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except TimeoutError:
+                        break
+                if item is None:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                await self._write_batch(batch)
+            except Exception:
+                self.ingest_stats["errors"] += 1
+                logger.exception(f"Failed to write {len(batch)} learned messages")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    @metrics.timed("db_query_seconds", query="write_batch")
+    async def _write_batch(self, batch):
+        # Re-check opt-in at write time in case someone opted out while their message was queued
+        rows = [item for item in batch if item[0] in self._opted_in]
+        self.ingest_stats["dropped_opted_out"] += len(batch) - len(rows)
+        if rows and self.dedup is not None:
+            with metrics.timer("dedup_seconds"):
+                rows = await self._deduplicate(rows)
+        if not rows:
+            return
+
+        by_corpus = collections.defaultdict(list)
+        for row in rows:
+            by_corpus[await self._corpus_for(row[2])].append(row)
+        # With per-guild files each has its own connection thread, so they commit in parallel
+        await asyncio.gather(*(corpus.write(corpus_rows) for corpus, corpus_rows in by_corpus.items()))
+        self.ingest_stats["written"] += len(rows)
+        self.ingest_stats["batches"] += 1
+
+        if self.retention_max_rows:
+            # A little slack so the cap is enforced in batches, not on every write
+            limit = self.retention_max_rows + max(1, self.retention_max_rows // 100)
+            for guild_id in {row[2] for row in rows}:
+                corpus = await self._corpus_for(guild_id)
+                if corpus.guild_counts.get(guild_id, 0) > limit:
+                    await corpus.trim_guild(guild_id, self.retention_max_rows)
+
+    async def _deduplicate(self, rows):
+        """Drop rows repeating a stored message exactly, or nearly one of the guild's recent ones."""
+        by_guild = collections.defaultdict(list)
+        for row in rows:
+            by_guild[row[2]].append(row)
+        dedup = self.dedup
+        kept = []
+        for guild_id, guild_rows in by_guild.items():
+            corpus = await self._corpus_for(guild_id)
+            hashes = [content_hash(row[1]) for row in guild_rows]
+            seen = await corpus.existing_hashes(guild_id, set(hashes))
+            if dedup.near_enabled and not dedup.has_window(guild_id):
+                # Hashing a few thousand messages takes a while; keep it off the event loop
+                await asyncio.to_thread(dedup.warm, guild_id, await corpus.recent_contents(guild_id, dedup.window))
+            for row, row_hash in zip(guild_rows, hashes):
+                if row_hash in seen:
+                    dedup.record("exact", row[1])
+                elif dedup.near_enabled and dedup.is_near_duplicate(guild_id, row[1]):
+                    dedup.record("near", row[1])
+                else:
+                    seen.add(row_hash)
+                    kept.append(row)
+        return kept
+
+    @property
+    def embedding_count(self) -> int:
+        return sum(corpus.embedding_count for corpus in self._corpora)
+
+    def message_count(self, guild_id: int = None) -> int:
+        """Learned messages in one guild, or in all of them. Answered from memory."""
+        if guild_id is None:
+            return sum(corpus.row_count for corpus in self._corpora)
+        corpus = self._shared or self._guild_corpora.get(guild_id)
+        return corpus.guild_counts.get(guild_id, 0) if corpus else 0
+
+    @metrics.timed("db_query_seconds", query="get_relevant_learned_messages")
+    async def get_relevant_learned_messages(self, query: str, limit=20, random_ratio=0.3, guild_id: int = 0):
+        """
+        Fetch the learned messages from `guild_id` most similar to `query`, topped
+        up with a few random ones so replies don't all echo the same topic. Falls
+        back to a random sample when retrieval is disabled or the index is empty.
+        """
+        corpus = await self._corpus_for(guild_id, create=False)
+        if corpus is None:
+            return []
+        return await corpus.relevant(query, limit, random_ratio, guild_id)
+
+    @metrics.timed("db_query_seconds", query="get_random_learned_messages")
+    async def get_random_learned_messages(self, limit=20, guild_id: int = None):
+        """
+        Fetch random messages to provide as 'context' for the personality, from
+        one guild or, with guild_id=None, from all of them (see Corpus.sample).
+        """
+        if self._shared is not None:
+            return await self._shared.sample(limit, guild_id)
+        if guild_id is not None:
+            corpus = self._guild_corpora.get(guild_id)
+            return await corpus.sample(limit) if corpus else []
+        # Across guild files: split the sample in proportion to each file's size
+        corpora = [corpus for corpus in self._guild_corpora.values() if corpus.row_count]
+        if not corpora:
+            return []
+        picks = collections.Counter(random.choices(corpora, weights=[c.row_count for c in corpora], k=limit))
+        results = []
+        for corpus, count in picks.items():
+            results.extend(await corpus.sample(count))
+        random.shuffle(results)
+        return results
+
+    @metrics.timed("db_query_seconds", query="get_stats")
+    async def get_stats(self, top=3, guild_id: int = None):
+        """
+        Opted-in user count, learned message total and the top contributors as
+        (user_id, count) rows, for one guild or all of them. Totals come from
+        memory and the leaderboard from user_stats, so this never scans
+        learned_messages.
+        """
+        if self._shared is not None:
+            top_contributors = await self._shared.top_contributors(top, guild_id)
+        elif guild_id is not None:
+            corpus = self._guild_corpora.get(guild_id)
+            top_contributors = await corpus.top_contributors(top) if corpus else []
+        else:
+            # A user can post in several guilds, so add up their counts from every file
+            totals = collections.Counter()
+            for corpus in self._corpora:
+                totals.update(await corpus.user_counts())
+            top_contributors = sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:top]
+
+        return len(self._opted_in), self.message_count(guild_id), top_contributors
+
+    async def verify_stats(self):
+        """
+        Recompute the stats from the base tables and compare them with what
+        get_stats() serves. Returns a list of mismatch descriptions (empty
+        when consistent). Scans the whole corpus; meant for maintenance.
+        """
+        await self.flush()
+        problems = []
+        async with self.db.execute("SELECT COUNT(*) FROM user_prefs WHERE opt_in = 1") as c:
+            opted_in = (await c.fetchone())[0]
+        if opted_in != len(self._opted_in):
+            problems.append(f"opted-in users: cached {len(self._opted_in)}, actual {opted_in}")
+        for corpus in self._corpora:
+            problems.extend(await corpus.verify_stats())
+        return problems
+
+    async def rebuild_stats(self):
+        """Recount user_stats and the cached totals from scratch."""
+        await self.flush()
+        for corpus in self._corpora:
+            await corpus.rebuild_stats()
+
+    async def _delete_where(self, condition, params=(), progress=None, guild_id=None):
+        """Delete matching learned messages, from one guild or all, in batches (see Corpus.delete_where)."""
+        if guild_id is None:
+            corpora = self._corpora
+        else:
+            condition, params = f"guild_id = ? AND {condition}", (guild_id, *params)
+            corpora = [corpus for corpus in [await self._corpus_for(guild_id, create=False)] if corpus]
+        total = 0
+        for corpus in corpora:
+            async def report(deleted, done=total):
+                await progress(done + deleted)
+            total += await corpus.delete_where(condition, params, report if progress else None)
+        return total
+
+    @metrics.timed("db_query_seconds", query="clear_all_messages")
+    async def clear_all_messages(self, progress=None, guild_id: int = None) -> int:
+        """Delete all learned messages, or all from one guild. Returns count of deleted messages."""
+        await self.flush()
+        count = await self._delete_where("1", progress=progress, guild_id=guild_id)
+        logger.info(f"Cleared {count} learned messages{f' from guild {guild_id}' if guild_id is not None else ''}.")
+        return count
+
+    @metrics.timed("db_query_seconds", query="clear_messages_before")
+    async def clear_messages_before(self, timestamp: str, progress=None, guild_id: int = None) -> int:
         """Delete messages before a specific timestamp. Returns count of deleted messages."""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("SELECT COUNT(*) FROM learned_messages WHERE timestamp < ?", (timestamp,)) as c:
-                count = (await c.fetchone())[0]
-            
-            await db.execute("DELETE FROM learned_messages WHERE timestamp < ?", (timestamp,))
-            await db.commit()
-            logger.info(f"Deleted {count} messages before {timestamp}.")
-            return count
-
-    async def clear_messages_after(self, timestamp: str) -> int:
+        timestamp = normalize_timestamp(timestamp)
+        await self.flush()
+        count = await self._delete_where("timestamp < ?", (timestamp,), progress, guild_id)
+        logger.info(f"Deleted {count} messages before {timestamp}.")
+        return count
+
+    @metrics.timed("db_query_seconds", query="clear_messages_after")
+    async def clear_messages_after(self, timestamp: str, progress=None, guild_id: int = None) -> int:
         """Delete messages after a specific timestamp. Returns count of deleted messages."""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("SELECT COUNT(*) FROM learned_messages WHERE timestamp > ?", (timestamp,)) as c:
-                count = (await c.fetchone())[0]
-            
-            await db.execute("DELETE FROM learned_messages WHERE timestamp > ?", (timestamp,))
-            await db.commit()
-            logger.info(f"Deleted {count} messages after {timestamp}.")
-            return count
+        timestamp = normalize_timestamp(timestamp)
+        await self.flush()
+        count = await self._delete_where("timestamp > ?", (timestamp,), progress, guild_id)
+        logger.info(f"Deleted {count} messages after {timestamp}.")
+        return count
+
+    @metrics.timed("db_query_seconds", query="remove_duplicate_messages")
+    async def remove_duplicate_messages(self, progress=None, guild_id: int = None) -> int:
+        """Delete stored messages that repeat a newer one in the same guild. Returns count of deleted messages."""
+        await self.flush()
+        if guild_id is None:
+            corpora = self._corpora
+        else:
+            corpora = [corpus for corpus in [await self._corpus_for(guild_id, create=False)] if corpus]
+        total = 0
+        for corpus in corpora:
+            async def report(deleted, done=total):
+                await progress(done + deleted)
+            total += await corpus.remove_duplicates(guild_id, report if progress else None)
+        logger.info(f"Removed {total} duplicate learned messages{f' from guild {guild_id}' if guild_id is not None else ''}.")
+        return total
+
+    @metrics.timed("db_query_seconds", query="enforce_retention")
+    async def enforce_retention(self) -> int:
+        """Delete messages older than retention_days, then each guild's oldest beyond retention_max_rows."""
+        deleted = 0
+        if self.retention_days:
+            cutoff = datetime.now(timezone.utc) - timedelta(days=self.retention_days)
+            deleted += await self._delete_where("timestamp < ?", (cutoff.strftime(TIMESTAMP_FORMAT),))
+        if self.retention_max_rows:
+            for corpus in self._corpora:
+                deleted += await corpus.trim_guilds(self.retention_max_rows)
+        if deleted:
+            logger.info(f"Retention removed {deleted} learned messages.")
+        return deleted
+
+    async def _retention_loop(self):
+        while True:
+            try:
+                await self.enforce_retention()
+            except Exception:
+                logger.exception("Retention pass failed")
+            await asyncio.sleep(self.retention_interval)
+
+    @metrics.timed("db_query_seconds", query="get_vision_description")
+    async def get_vision_description(self, image_hash: str, max_age: float):
+        """Get a cached image description no older than max_age seconds, or None."""
+        async with self.db.execute(
+            "SELECT description FROM vision_cache WHERE image_hash = ? AND created_at >= ?",
+            (image_hash, time.time() - max_age),
+        ) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+    @metrics.timed("db_query_seconds", query="set_vision_description")
+    async def set_vision_description(self, image_hash: str, description: str, max_age: float):
+        """Cache an image description, dropping any older than max_age seconds."""
+        now = time.time()
+        async with self._write_lock:
+            await self.db.execute("""
+                INSERT INTO vision_cache (image_hash, description, created_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(image_hash) DO UPDATE SET description = excluded.description, created_at = excluded.created_at
+            """, (image_hash, description, now))
+            await self.db.execute("DELETE FROM vision_cache WHERE created_at < ?", (now - max_age,))
+            await self.db.commit()
 
     async def get_vision_enabled(self) -> bool:
         """Get whether vision processing is enabled."""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("SELECT value FROM bot_settings WHERE key = 'vision_enabled'") as cursor:
-                row = await cursor.fetchone()
-                return bool(int(row[0])) if row else True  # Default to True
+        async with self.db.execute("SELECT value FROM bot_settings WHERE key = 'vision_enabled'") as cursor:
+            row = await cursor.fetchone()
+            return bool(int(row[0])) if row else True  # Default to True
 
     async def set_vision_enabled(self, enabled: bool):
         """Set whether vision processing is enabled."""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                INSERT INTO bot_settings (key, value)
-                VALUES ('vision_enabled', ?)
-                ON CONFLICT(key) DO UPDATE SET value = excluded.value
-            """, (1 if enabled else 0,))
-            await db.commit()
+        await self.db.execute("""
+            INSERT INTO bot_settings (key, value)
+            VALUES ('vision_enabled', ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """, (1 if enabled else 0,))
+        await self.db.commit()
@@ -0,0 +1,171 @@
+import hashlib
+import re
+from collections import OrderedDict
+
+import numpy as np
+
+from prompt import estimate_tokens
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+_SPACE_RE = re.compile(r"\s+")
+
+_SHIFT = np.uint64(32)
+_BYTE = np.uint64(8)
+
+
+def normalize_text(text):
+    """Casefold and drop punctuation and extra whitespace, so trivial variants compare equal."""
+    folded = _SPACE_RE.sub(" ", text.casefold()).strip()
+    stripped = _SPACE_RE.sub(" ", _PUNCTUATION_RE.sub("", folded)).strip()
+    # Emoji- or punctuation-only messages would all normalize to ""
+    return stripped or folded
+
+
+def content_hash(text):
+    """64-bit signed hash of the normalized text, as stored in learned_messages.content_hash."""
+    digest = hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+class MinHasher:
+    """MinHash signatures over byte shingles of normalized text."""
+
+    def __init__(self, num_perm=64, shingle=4, seed=1):
+        if not 1 <= shingle <= 4:
+            raise ValueError("shingle must be 1-4 bytes")
+        self.num_perm = num_perm
+        self.shingle = shingle
+        rng = np.random.default_rng(seed)
+        # Multiply-add-shift hashing: ((a * x + b) mod 2^64) >> 32 with odd a
+        self._a = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+
+    def signature(self, text):
+        data = np.frombuffer(normalize_text(text).encode("utf-8"), dtype=np.uint8).astype(np.uint64)
+        size = self.shingle
+        if len(data) < size:
+            data = np.concatenate([data, np.zeros(size - len(data), dtype=np.uint64)])
+        # Pack each run of `size` bytes into one integer
+        count = len(data) - size + 1
+        shingles = data[:count].copy()
+        for offset in range(1, size):
+            shingles = (shingles << _BYTE) | data[offset:offset + count]
+        # One row per permutation, one column per shingle; the min of each row is the
+        # signature. uint64 arithmetic wraps on overflow, which numpy allows for arrays.
+        permuted = (np.outer(self._a, shingles) + self._b[:, None]) >> _SHIFT
+        return permuted.min(axis=1).astype(np.uint32)
+
+
+class NearDuplicateIndex:
+    """
+    MinHash signatures of the last `window` messages of one guild, bucketed by
+    LSH band. A new message is a near duplicate when a message sharing a band
+    has an estimated Jaccard similarity of at least `threshold`.
+    """
+
+    def __init__(self, hasher, window=5000, bands=16, threshold=0.8):
+        if hasher.num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.hasher = hasher
+        self.window = window
+        self.bands = bands
+        self.rows = hasher.num_perm // bands
+        self.threshold = threshold
+        self._signatures = np.zeros((window, hasher.num_perm), dtype=np.uint32)
+        self._used = 0
+        self._next = 0  # Slot the next signature overwrites once the window is full
+        self._buckets = [{} for _ in range(bands)]  # band key -> set of slots
+
+    def __len__(self):
+        return self._used
+
+    def _keys(self, signature):
+        return [signature[b * self.rows:(b + 1) * self.rows].tobytes() for b in range(self.bands)]
+
+    def check(self, signature):
+        """Return the best similarity to a recent message in a shared bucket (0.0 if none)."""
+        candidates = set()
+        for bucket, key in zip(self._buckets, self._keys(signature)):
+            candidates.update(bucket.get(key, ()))
+        if not candidates:
+            return 0.0
+        slots = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        return float((self._signatures[slots] == signature).mean(axis=1).max())
+
+    def add(self, signature):
+        slot = self._next
+        if self._used == self.window:
+            # Forget the oldest signature this slot held
+            for bucket, key in zip(self._buckets, self._keys(self._signatures[slot])):
+                members = bucket.get(key)
+                if members is not None:
+                    members.discard(slot)
+                    if not members:
+                        del bucket[key]
+        else:
+            self._used += 1
+        self._signatures[slot] = signature
+        for bucket, key in zip(self._buckets, self._keys(signature)):
+            bucket.setdefault(key, set()).add(slot)
+        self._next = (slot + 1) % self.window
+
+    @property
+    def nbytes(self):
+        return self._signatures.nbytes
+
+
+class Deduplicator:
+    """
+    Ingest-time duplicate filter: exact repeats by normalized hash, near repeats
+    by MinHash/LSH over each guild's most recent messages. Windows are kept for
+    up to max_guilds guilds, least recently active dropped first.
+    """
+
+    def __init__(self, threshold=0.8, window=5000, num_perm=64, bands=16, max_guilds=100):
+        self.threshold = threshold
+        self.window = window
+        self.bands = bands
+        self.max_guilds = max_guilds
+        self.hasher = MinHasher(num_perm)
+        self._guilds = OrderedDict()  # guild_id -> NearDuplicateIndex
+        self.stats = {"exact": 0, "near": 0, "bytes_saved": 0, "tokens_saved": 0}
+
+    @property
+    def near_enabled(self):
+        return self.threshold < 1.0
+
+    def has_window(self, guild_id):
+        return guild_id in self._guilds
+
+    def window_for(self, guild_id):
+        index = self._guilds.get(guild_id)
+        if index is None:
+            index = self._guilds[guild_id] = NearDuplicateIndex(self.hasher, self.window, self.bands, self.threshold)
+            while len(self._guilds) > self.max_guilds:
+                self._guilds.popitem(last=False)
+        self._guilds.move_to_end(guild_id)
+        return index
+
+    def warm(self, guild_id, contents):
+        """Seed a guild's window with its recent messages, oldest first."""
+        index = self.window_for(guild_id)
+        for content in contents:
+            index.add(self.hasher.signature(content))
+
+    def is_near_duplicate(self, guild_id, content):
+        """Check `content` against the guild's window, adding it if it is new."""
+        index = self.window_for(guild_id)
+        signature = self.hasher.signature(content)
+        if index.check(signature) >= self.threshold:
+            return True
+        index.add(signature)
+        return False
+
+    def record(self, kind, content):
+        self.stats[kind] += 1
+        self.stats["bytes_saved"] += len(content.encode("utf-8"))
+        self.stats["tokens_saved"] += estimate_tokens(content)
+
+    @property
+    def nbytes(self):
+        return sum(index.nbytes for index in self._guilds.values())
@@ -0,0 +1,140 @@
+from collections import OrderedDict
+
+# Rough per-entry overhead of the tuple, dict slot and int key, on top of the text
+ENTRY_OVERHEAD = 120
+
+
+class _ChannelBuffer:
+    __slots__ = ("messages", "backfilled", "nbytes")
+
+    def __init__(self):
+        self.messages = OrderedDict()  # message_id -> (author, content), oldest first
+        self.backfilled = False
+        self.nbytes = 0
+
+
+class ChannelHistory:
+    """
+    The last few messages of each channel, kept from gateway events so building
+    a reply doesn't need a channel.history() REST call.
+
+    Channels are evicted least-recently-used once there are more than
+    max_channels of them or the buffered text exceeds max_bytes.
+    """
+
+    def __init__(self, per_channel=10, max_channels=1000, max_bytes=8 * 1024 * 1024):
+        self.per_channel = per_channel
+        self.max_channels = max_channels
+        self.max_bytes = max_bytes
+        self._channels = OrderedDict()  # channel_id -> _ChannelBuffer, least recently used first
+        self._bytes = 0
+        self.stats = {"hits": 0, "backfills": 0, "evictions": 0}
+
+    def __len__(self):
+        return len(self._channels)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    @staticmethod
+    def _size(author, content):
+        return ENTRY_OVERHEAD + len(author) + len(content)
+
+    def _buffer(self, channel_id):
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            buffer = self._channels[channel_id] = _ChannelBuffer()
+        else:
+            self._channels.move_to_end(channel_id)
+        return buffer
+
+    def _put(self, buffer, message_id, author, content):
+        old = buffer.messages.pop(message_id, None)
+        if old is not None:
+            buffer.nbytes -= self._size(*old)
+        buffer.messages[message_id] = (author, content)
+        buffer.nbytes += self._size(author, content)
+        while len(buffer.messages) > self.per_channel:
+            _, dropped = buffer.messages.popitem(last=False)
+            buffer.nbytes -= self._size(*dropped)
+
+    def _evict(self):
+        while self._channels and (len(self._channels) > self.max_channels or self._bytes > self.max_bytes):
+            _, buffer = self._channels.popitem(last=False)
+            self._bytes -= buffer.nbytes
+            self.stats["evictions"] += 1
+
+    def add(self, channel_id, message_id, author, content):
+        """Record a message seen on the gateway."""
+        buffer = self._buffer(channel_id)
+        self._bytes -= buffer.nbytes
+        self._put(buffer, message_id, author, content)
+        self._bytes += buffer.nbytes
+        self._evict()
+
+    def edit(self, channel_id, message_id, content):
+        buffer = self._channels.get(channel_id)
+        if buffer is None or message_id not in buffer.messages:
+            return
+        author, _ = buffer.messages[message_id]
+        self._bytes -= buffer.nbytes
+        # Replace in place so the edit doesn't move the message to the end
+        buffer.nbytes += self._size(author, content) - self._size(*buffer.messages[message_id])
+        buffer.messages[message_id] = (author, content)
+        self._bytes += buffer.nbytes
+        self._evict()
+
+    def delete(self, channel_id, message_ids):
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return
+        for message_id in message_ids:
+            old = buffer.messages.pop(message_id, None)
+            if old is not None:
+                size = self._size(*old)
+                buffer.nbytes -= size
+                self._bytes -= size
+
+    def forget_channel(self, channel_id):
+        buffer = self._channels.pop(channel_id, None)
+        if buffer is not None:
+            self._bytes -= buffer.nbytes
+
+    def needs_backfill(self, channel_id):
+        """True if messages from before we started watching this channel may be missing."""
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return True
+        return not buffer.backfilled and len(buffer.messages) < self.per_channel
+
+    def backfill(self, channel_id, entries):
+        """Merge (message_id, author, content) entries fetched from the REST API."""
+        buffer = self._buffer(channel_id)
+        self._bytes -= buffer.nbytes
+        merged = dict(buffer.messages)
+        for message_id, author, content in entries:
+            # Anything seen live is at least as fresh as what REST returned
+            merged.setdefault(message_id, (author, content))
+        # Snowflake ids are time-ordered, so sorting by id restores chronology
+        buffer.messages = OrderedDict(sorted(merged.items()))
+        buffer.nbytes = sum(self._size(*entry) for entry in buffer.messages.values())
+        while len(buffer.messages) > self.per_channel:
+            _, dropped = buffer.messages.popitem(last=False)
+            buffer.nbytes -= self._size(*dropped)
+        buffer.backfilled = True
+        self._bytes += buffer.nbytes
+        self.stats["backfills"] += 1
+        self._evict()
+
+    def recent(self, channel_id, limit=None, exclude=None):
+        """Return up to `limit` "author: content" lines, oldest first, skipping message `exclude`."""
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return []
+        self.stats["hits"] += 1
+        lines = [f"{author}: {content}" for message_id, (author, content) in buffer.messages.items()
+                 if message_id != exclude]
+        if limit is not None:
+            lines = lines[-limit:] if limit else []
+        return lines
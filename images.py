@@ -0,0 +1,152 @@
+import asyncio
+import base64
+import hashlib
+import io
+import logging
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# LLaVA 1.6 (Ollama's default llava) works on images up to 672px per side;
+# anything larger is scaled down by the model anyway.
+LLAVA_MAX_SIDE = 672
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def downscale(data, max_side=LLAVA_MAX_SIDE, quality=85):
+    """Shrink an encoded image so neither side exceeds max_side. Small images are returned as-is."""
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= max_side:
+            return data
+        image.thumbnail((max_side, max_side))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=quality)
+    resized = out.getvalue()
+    # Re-encoding can make tiny, flat images bigger; keep whichever is smaller
+    return resized if len(resized) < len(data) else data
+
+
+class ImageFetcher:
+    """
+    Downloads image attachments for the vision model over a shared session.
+
+    Attachments are fetched concurrently. Anything over max_bytes is rejected
+    before downloading when Discord or the server reports its size, and the
+    read stops at the cap otherwise. Images are downscaled to what LLaVA uses
+    before being base64-encoded.
+    """
+
+    def __init__(self, session, max_bytes=1024 * 1024, max_side=LLAVA_MAX_SIDE, chunk_size=64 * 1024):
+        self.session = session
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self.chunk_size = chunk_size
+        self.stats = {"fetched": 0, "rejected_size": 0, "errors": 0, "bytes_downloaded": 0, "bytes_sent": 0}
+
+    async def fetch_all(self, attachments):
+        """Return base64 payloads for every attachment that could be fetched, in order."""
+        results = await asyncio.gather(*(self.fetch(a) for a in attachments))
+        return [r for r in results if r is not None]
+
+    async def fetch(self, attachment):
+        if attachment.size and attachment.size > self.max_bytes:
+            self.stats["rejected_size"] += 1
+            logger.warning(f"Skipping image {attachment.filename}: {attachment.size} bytes")
+            return None
+        try:
+            data = await self._download(attachment.url)
+            if self.max_side:
+                data = await asyncio.to_thread(downscale, data, self.max_side)
+        except ImageTooLarge as e:
+            self.stats["rejected_size"] += 1
+            logger.warning(f"Skipping image {attachment.filename}: {e}")
+            return None
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Error downloading image: {e}")
+            return None
+        self.stats["fetched"] += 1
+        self.stats["bytes_sent"] += len(data)
+        return base64.b64encode(data).decode('utf-8')
+
+    async def _download(self, url):
+        async with self.session.get(url) as resp:
+            resp.raise_for_status()
+            if resp.content_length is not None and resp.content_length > self.max_bytes:
+                raise ImageTooLarge(f"Content-Length {resp.content_length}")
+            buffer = bytearray()
+            async for chunk in resp.content.iter_chunked(self.chunk_size):
+                buffer += chunk
+                self.stats["bytes_downloaded"] += len(chunk)
+                if len(buffer) > self.max_bytes:
+                    raise ImageTooLarge(f"more than {self.max_bytes} bytes")
+            return bytes(buffer)
+
+
+def image_key(b64_image):
+    """Content address of an image payload."""
+    return hashlib.sha256(b64_image.encode("ascii")).hexdigest()
+
+
+class VisionCache:
+    """
+    LLaVA descriptions of images, keyed by content hash, so a reposted image
+    skips the vision model. Recent entries live in an in-memory LRU. With a
+    DatabaseManager, entries are also persisted in SQLite for ttl seconds.
+    """
+
+    def __init__(self, max_entries=512, db=None, ttl=7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.db = db
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (description, created_at)
+        self.stats = {"hits": 0, "misses": 0, "vision_seconds": 0.0}
+
+    @property
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    @property
+    def saved_seconds(self):
+        """Estimated vision inference time avoided: hits times the average miss cost."""
+        if not self.stats["misses"]:
+            return 0.0
+        return self.stats["hits"] * self.stats["vision_seconds"] / self.stats["misses"]
+
+    def _remember(self, key, description):
+        self._entries[key] = (description, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, key):
+        description = None
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry[1] <= self.ttl:
+            description = entry[0]
+            self._entries.move_to_end(key)
+        elif self.db is not None:
+            description = await self.db.get_vision_description(key, self.ttl)
+            if description is not None:
+                self._remember(key, description)
+        if description is None:
+            self.stats["misses"] += 1
+        else:
+            self.stats["hits"] += 1
+        return description
+
+    async def put(self, key, description, elapsed):
+        """Store a fresh description; `elapsed` is how long the vision model took for it."""
+        self.stats["vision_seconds"] += elapsed
+        self._remember(key, description)
+        if self.db is not None:
+            await self.db.set_vision_description(key, description, self.ttl)
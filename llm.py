@@ -0,0 +1,396 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+
+import aiohttp
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "http://127.0.0.1:11434"
+
+# A sentence counts as finished once its terminator is followed by whitespace,
+# so "3." in "3.5" or a trailing "." mid-stream doesn't end it early.
+SENTENCE_END_RE = re.compile(r"[.!?…]+[\"')\]]*\s")
+
+
+class OllamaError(Exception):
+    """Raised when the Ollama API returns an error or can't be reached."""
+
+
+class OllamaUnavailable(OllamaError):
+    """Raised when an Ollama server can't be reached, times out or fails with a 5xx."""
+
+
+def cut_after_sentences(text, count):
+    """Return the first `count` complete sentences of `text`, or None if it has fewer."""
+    ends = 0
+    for match in SENTENCE_END_RE.finditer(text):
+        ends += 1
+        if ends >= count:
+            return text[:match.end()].rstrip()
+    return None
+
+
+def parse_keep_alive(value):
+    """keep_alive as Ollama wants it: plain numbers are seconds, anything else a duration such as "30m"."""
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+class OllamaClient:
+    """
+    Minimal async client for the Ollama HTTP API.
+
+    All requests share one aiohttp session. A semaphore caps how many are in
+    flight at once, so a burst of triggers queues here instead of piling onto
+    Ollama (or the default thread pool).
+    """
+
+    def __init__(self, host=None, max_concurrency=2, timeout=120.0, connect_timeout=5.0):
+        self.host = (host or os.getenv("OLLAMA_HOST") or DEFAULT_HOST).rstrip("/")
+        if "://" not in self.host:
+            self.host = f"http://{self.host}"
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+        self.in_flight = 0
+        self.waiting = 0
+        self.stats = {"requests": 0, "errors": 0, "timeouts": 0, "stopped_early": 0}
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _timeout(self, timeout):
+        total = self.timeout if timeout is None else timeout
+        return aiohttp.ClientTimeout(total=total, sock_connect=self.connect_timeout)
+
+    async def chat(self, model, messages, options=None, keep_alive=None, stream=False,
+                   stop_after_sentences=None, timeout=None):
+        """
+        Run a chat completion and return the reply text.
+
+        With stream=True and stop_after_sentences set, the response is read as it
+        is generated and the connection is closed as soon as that many sentences
+        have arrived, which makes Ollama stop generating.
+        """
+        payload = {"model": model, "messages": messages, "stream": stream}
+        if options:
+            payload["options"] = options
+        if keep_alive is not None:
+            payload["keep_alive"] = keep_alive
+
+        self.waiting += 1
+        queued = time.perf_counter()
+        async with self._semaphore:
+            self.waiting -= 1
+            self.in_flight += 1
+            self.stats["requests"] += 1
+            started = time.perf_counter()
+            metrics.observe("llm_queue_seconds", started - queued, model=model)
+            try:
+                async with self._get_session().post(
+                    f"{self.host}/api/chat", json=payload, timeout=self._timeout(timeout)
+                ) as resp:
+                    if resp.status != 200:
+                        error = OllamaUnavailable if resp.status >= 500 else OllamaError
+                        raise error(f"{resp.status} from /api/chat: {(await resp.text())[:200]}")
+                    if not stream:
+                        data = await resp.json(content_type=None)
+                        self._record_eval(model, data)
+                        return data["message"]["content"]
+                    return await self._read_stream(resp, model, started, stop_after_sentences)
+            except asyncio.TimeoutError as e:
+                self.stats["timeouts"] += 1
+                metrics.inc("llm_errors_total", model=model, error="timeout")
+                raise OllamaUnavailable(f"Timed out waiting for {model} at {self.host}") from e
+            except aiohttp.ClientError as e:
+                self.stats["errors"] += 1
+                metrics.inc("llm_errors_total", model=model, error="connection")
+                raise OllamaUnavailable(f"Error talking to Ollama at {self.host}: {e}") from e
+            except OllamaError:
+                metrics.inc("llm_errors_total", model=model, error="api")
+                raise
+            finally:
+                self.in_flight -= 1
+                metrics.observe("llm_request_seconds", time.perf_counter() - started, model=model)
+
+    async def ping(self, timeout=5.0):
+        """True if the server answers /api/version."""
+        try:
+            async with self._get_session().get(f"{self.host}/api/version", timeout=self._timeout(timeout)) as resp:
+                return resp.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def load(self, model, keep_alive=None, options=None):
+        """
+        Load `model` into memory; a generate request without a prompt only loads it.
+
+        Pass the options later requests will use: Ollama reloads the model when
+        num_ctx changes, which would undo the warm-up.
+        """
+        payload = {"model": model}
+        if options:
+            payload["options"] = options
+        if keep_alive is not None:
+            payload["keep_alive"] = keep_alive
+        try:
+            async with self._get_session().post(
+                f"{self.host}/api/generate", json=payload, timeout=self._timeout(None)
+            ) as resp:
+                if resp.status != 200:
+                    raise OllamaError(f"{resp.status} loading {model}: {(await resp.text())[:200]}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise OllamaUnavailable(f"Error loading {model} at {self.host}: {e}") from e
+
+    async def pull(self, model):
+        """Download `model`; only the connect timeout applies since a pull can take many minutes."""
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout)
+        try:
+            async with self._get_session().post(
+                f"{self.host}/api/pull", json={"model": model, "stream": False}, timeout=timeout
+            ) as resp:
+                if resp.status != 200:
+                    error = OllamaUnavailable if resp.status >= 500 else OllamaError
+                    raise error(f"{resp.status} pulling {model}: {(await resp.text())[:200]}")
+        except aiohttp.ClientError as e:
+            raise OllamaUnavailable(f"Error pulling {model} at {self.host}: {e}") from e
+
+    @staticmethod
+    def _record_eval(model, data):
+        """Record the generation speed Ollama reports in a final response."""
+        if data.get("eval_count") and data.get("eval_duration"):
+            metrics.inc("llm_eval_tokens_total", data["eval_count"], model=model)
+            metrics.inc("llm_eval_seconds_total", data["eval_duration"] / 1e9, model=model)
+
+    async def _read_stream(self, resp, model, started, stop_after_sentences):
+        text = ""
+        first_token_at = None
+        chunks = 0
+        async for line in resp.content:
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise OllamaError(chunk["error"])
+            part = chunk.get("message", {}).get("content", "")
+            if part:
+                chunks += 1
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    metrics.observe("llm_time_to_first_token_seconds", first_token_at - started, model=model)
+            text += part
+            if chunk.get("done"):
+                self._record_eval(model, chunk)
+                break
+            if stop_after_sentences:
+                cut = cut_after_sentences(text, stop_after_sentences)
+                if cut is not None:
+                    self.stats["stopped_early"] += 1
+                    # No final stats when we hang up, so count streamed chunks (one token each)
+                    metrics.inc("llm_eval_tokens_total", chunks, model=model)
+                    metrics.inc("llm_eval_seconds_total", time.perf_counter() - first_token_at, model=model)
+                    # Dropping the connection is how Ollama is told to stop generating
+                    resp.close()
+                    return cut
+        return text
+
+
+def parse_hosts(value):
+    """
+    Parse OLLAMA_HOSTS: endpoints separated by ";" or whitespace, each a host
+    optionally followed by "=" and the comma-separated models it keeps loaded,
+    e.g. "http://gpu1:11434=llama3.2:3b;http://gpu2:11434=llava".
+    Returns (host, models) pairs; models is None for untagged hosts.
+    """
+    endpoints = []
+    for entry in re.split(r"[;\s]+", value.strip()):
+        if not entry:
+            continue
+        host, _, models = entry.partition("=")
+        endpoints.append((host, [m for m in models.split(",") if m] or None))
+    return endpoints
+
+
+class OllamaEndpoint:
+    """One Ollama server in an OllamaPool, and the models it keeps loaded."""
+
+    def __init__(self, client, models=None):
+        self.client = client
+        self.models = set(models) if models else None  # None serves any model
+        self.healthy = True
+
+    @property
+    def host(self):
+        return self.client.host
+
+    @property
+    def load(self):
+        return (self.client.in_flight + self.client.waiting) / self.client.max_concurrency
+
+    def serves(self, model):
+        return self.models is None or model in self.models
+
+    def keeps_loaded(self, model):
+        return self.models is not None and model in self.models
+
+
+class OllamaPool:
+    """
+    Spreads requests over several Ollama servers.
+
+    A request goes to the least loaded healthy endpoint tagged with its model,
+    then to untagged ones (which load models on demand), then to healthy
+    endpoints tagged for other models. If an endpoint can't be reached, times
+    out or fails with a 5xx, it is ejected and the request is retried on the
+    next one; ejected endpoints are only tried as a last resort. Once started,
+    ejected endpoints are probed every probe_interval seconds and re-warmed
+    once they answer again.
+
+    Offers the same chat()/pull()/close() interface as OllamaClient.
+    """
+
+    def __init__(self, endpoints, probe_interval=10.0):
+        if not endpoints:
+            raise ValueError("OllamaPool needs at least one endpoint")
+        self.endpoints = endpoints
+        self.probe_interval = probe_interval
+        self.warm_models = []  # Loaded on untagged endpoints by warm()
+        self.warm_options = {}  # model -> options to load it with
+        self.keep_alive = None
+        self._probe_task = None
+        self.stats = {"failovers": 0, "ejections": 0, "recoveries": 0}
+
+    @classmethod
+    def from_hosts(cls, hosts, max_concurrency=2, timeout=120.0, **kwargs):
+        """Build a pool from parse_hosts() output, with one client per host."""
+        return cls([OllamaEndpoint(OllamaClient(host, max_concurrency, timeout), models) for host, models in hosts],
+                   **kwargs)
+
+    @property
+    def in_flight(self):
+        return sum(e.client.in_flight for e in self.endpoints)
+
+    @property
+    def waiting(self):
+        return sum(e.client.waiting for e in self.endpoints)
+
+    @property
+    def max_concurrency(self):
+        return sum(e.client.max_concurrency for e in self.endpoints)
+
+    @property
+    def healthy_count(self):
+        return sum(e.healthy for e in self.endpoints)
+
+    def start(self):
+        """Start re-probing ejected endpoints. Needs a running event loop."""
+        if self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+            self._probe_task = None
+        await asyncio.gather(*(e.client.close() for e in self.endpoints))
+
+    def _candidates(self, model):
+        """Endpoints in the order to try them for `model`."""
+        # Every endpoint is a candidate so a request fails over instead of failing;
+        # Ollama loads missing models itself, so endpoints tagged for other models
+        # come after the serving ones but before any ejected endpoint
+        return sorted(self.endpoints, key=lambda e: (not e.healthy, not e.serves(model), not e.keeps_loaded(model), e.load))
+
+    def _eject(self, endpoint, error):
+        if endpoint.healthy:
+            endpoint.healthy = False
+            self.stats["ejections"] += 1
+            metrics.inc("llm_endpoint_ejections_total", host=endpoint.host)
+            logger.warning(f"Ejecting Ollama endpoint {endpoint.host}: {error}")
+
+    def _restore(self, endpoint):
+        if not endpoint.healthy:
+            endpoint.healthy = True
+            self.stats["recoveries"] += 1
+            logger.info(f"Ollama endpoint {endpoint.host} is back")
+
+    async def chat(self, model, messages, **kwargs):
+        """OllamaClient.chat() on the best endpoint for `model`, failing over to the others."""
+        error = None
+        for attempt, endpoint in enumerate(self._candidates(model)):
+            if attempt:
+                self.stats["failovers"] += 1
+                metrics.inc("llm_failovers_total", model=model)
+            try:
+                return await endpoint.client.chat(model, messages, **kwargs)
+            except OllamaUnavailable as e:
+                self._eject(endpoint, e)
+                error = e
+        raise error
+
+    async def _warm_endpoint(self, endpoint):
+        models = endpoint.models if endpoint.models is not None else self.warm_models
+        for model in models:
+            try:
+                await endpoint.client.load(model, self.keep_alive, self.warm_options.get(model))
+            except OllamaUnavailable as e:
+                self._eject(endpoint, e)
+                return
+            except OllamaError as e:
+                logger.warning(f"Could not load {model} on {endpoint.host}: {e}")
+
+    async def warm(self, models=(), keep_alive=None, options=None):
+        """
+        Load each endpoint's tagged models (or `models` on untagged endpoints)
+        so the first replies don't wait for a model load. `options` maps a
+        model to the options its requests use; the probe re-warms with them too.
+        """
+        self.warm_models = list(models)
+        self.warm_options = dict(options or {})
+        self.keep_alive = keep_alive
+        await asyncio.gather(*(self._warm_endpoint(e) for e in self.endpoints))
+
+    async def pull(self, model):
+        """
+        Download `model` on every endpoint that serves it (every endpoint if
+        none does) and return their hosts. Raises the first error once all
+        pulls have finished.
+        """
+        endpoints = [e for e in self.endpoints if e.serves(model)] or list(self.endpoints)
+        results = await asyncio.gather(*(e.client.pull(model) for e in endpoints), return_exceptions=True)
+        errors = []
+        for endpoint, result in zip(endpoints, results):
+            if isinstance(result, OllamaUnavailable):
+                self._eject(endpoint, result)
+            if isinstance(result, Exception):
+                errors.append(result)
+        if errors:
+            raise errors[0]
+        return [e.host for e in endpoints]
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            ejected = [e for e in self.endpoints if not e.healthy]
+            answers = await asyncio.gather(*(e.client.ping() for e in ejected))
+            for endpoint, answered in zip(ejected, answers):
+                if answered:
+                    self._restore(endpoint)
+                    await self._warm_endpoint(endpoint)
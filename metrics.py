@@ -0,0 +1,159 @@
+import bisect
+import functools
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Bucket upper bounds in seconds: 50us doubling up to ~105s
+BUCKETS = tuple(0.00005 * 2 ** i for i in range(22))
+
+
+class Histogram:
+    """Fixed-bucket histogram; observing is a bisect and two additions."""
+
+    __slots__ = ("counts", "sum", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (capped at the observed max)."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = [f'{k}="{v}"' for k, v in (*labels, *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metrics:
+    """In-memory registry of counters, histograms and gauges, keyed by name and labels."""
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.histograms = defaultdict(Histogram)
+        self.gauges = {}  # name -> callable returning the current value
+
+    def inc(self, name, amount=1, **labels):
+        self.counters[_key(name, labels)] += amount
+
+    def observe(self, name, value, **labels):
+        self.histograms[_key(name, labels)].observe(value)
+
+    def gauge(self, name, fn):
+        """Register a callable that is read whenever metrics are rendered."""
+        self.gauges[name] = fn
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, **labels):
+        """Decorator recording how long an async function takes."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return await fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _gauge_values(self):
+        values = {}
+        for name, fn in self.gauges.items():
+            try:
+                values[name] = float(fn())
+            except Exception as e:
+                logger.debug(f"Gauge {name} failed: {e}")
+        return values
+
+    def render_text(self):
+        """Compact human-readable summary, for the /perf command."""
+        lines = []
+        for (name, labels), hist in sorted(self.histograms.items()):
+            label_str = ",".join(f"{v}" for _, v in labels)
+            lines.append(
+                f"{name}[{label_str}] n={hist.count} avg={hist.sum / hist.count * 1e3:.1f}ms "
+                f"p50={hist.quantile(0.5) * 1e3:.1f} p95={hist.quantile(0.95) * 1e3:.1f} "
+                f"p99={hist.quantile(0.99) * 1e3:.1f} max={hist.max * 1e3:.1f}"
+            )
+        for (name, labels), value in sorted(self.counters.items()):
+            label_str = ",".join(f"{v}" for _, v in labels)
+            lines.append(f"{name}[{label_str}] {value:g}")
+        for name, value in sorted(self._gauge_values().items()):
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines)
+
+    def render_prometheus(self):
+        """Prometheus text exposition format."""
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        for (name, labels), hist in sorted(self.histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(BUCKETS, hist.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {hist.count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {hist.sum:g}")
+            lines.append(f"{name}_count{_format_labels(labels)} {hist.count}")
+        for name, value in sorted(self._gauge_values().items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+# Shared registry for the whole bot
+metrics = Metrics()
+
+
+async def start_metrics_server(port, host="127.0.0.1", registry=metrics):
+    """Serve registry.render_prometheus() at http://host:port/metrics. Returns the runner to clean up."""
+    async def handle(request):
+        return web.Response(text=registry.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
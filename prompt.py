@@ -0,0 +1,143 @@
+"""
+Prompt layout for replies.
+
+The system message is the same for every request, so Ollama can keep it in
+its KV cache and only evaluate what follows. Everything that changes per
+reply (learned messages, chat history, images, the trigger) goes in the user
+message after it, trimmed to fit the context window.
+"""
+
+IDENTITY = """You are a funny, slightly chaotic Discord bot named Shady.
+You were created by: iota (vorlie#614807913302851594)
+CRITICAL: Never mention yourself by name. Never use the word "Shady" or "@Shady". Always speak from your own perspective.
+Do not act like an AI, act like a regular person in the chat.
+NEVER REFER TO YOURSELF AS "SHADY", "THE BOT", "I AM SHADY", OR ANY VARIATION. You are just a person chatting.
+FORBIDDEN WORDS/PHRASES: "I'm here", "I can help", "let me know", "I'm", "I am", "I can", "I will", "my skills", "I think", "I feel" when referring to yourself."""
+
+INSTRUCTIONS = """--- YOUR INSTRUCTIONS ---
+Your goal is to send a short, funny message that is LOGICALLY RELEVANT to the RECENT CONVERSATION while adopting the "vibe" of the LEARNED messages.
+Your response must make sense in context. Do not just blurt out random phrases.
+If someone asks a question, try to answer it in a funny/chaotic way instead of ignoring it.
+Keep it short (1-2 sentences).
+Do not use emojis unless the learned messages use them.
+Do not use quotation marks around your response.
+NEVER START YOUR MESSAGE WITH "Shady:" or "@Shady:".
+ABSOLUTELY FORBIDDEN: Do not end your message with any reference to yourself, your name, or sign off as "Shady".
+RESPONSE STYLE: Speak as if you are just another user in the chat. No self-promotion, no offers of help, no "I'm here for you" type statements."""
+
+SYSTEM_PROMPT = f"{IDENTITY}\n\n{INSTRUCTIONS}"
+
+VIBE_HEADER = "--- LEARNED VIBE (Sentences you've learned from users) ---"
+HISTORY_HEADER = "--- RECENT CONVERSATION (What just happened in chat) ---"
+IMAGES_HEADER = "--- POSTED IMAGES (What the attached images show) ---"
+
+# Chat template tokens around each message (role headers, end-of-turn)
+MESSAGE_OVERHEAD = 8
+
+
+def estimate_tokens(text):
+    """Rough token count: Llama-style tokenizers average about 4 bytes of chat text per token."""
+    return max(1, (len(text.encode("utf-8")) + 3) // 4)
+
+
+def truncate(text, max_tokens):
+    """Cut `text` to about `max_tokens` tokens, on a character boundary."""
+    limit = max_tokens * 4
+    data = text.encode("utf-8")
+    if len(data) <= limit:
+        return text
+    return data[:limit].decode("utf-8", errors="ignore").rstrip() + "…"
+
+
+def request_text(user_message=None, images=False):
+    if images:
+        return (f"Someone just posted the image(s) described above with this message: "
+                f"'{user_message or 'Check out this image!'}'. Respond to it in a funny way, reflecting the vibe "
+                f"of what you've learned. REMINDER: Do not mention yourself or 'Shady' in the reply.")
+    if user_message:
+        return (f"Someone just said: '{user_message}'. Respond to it in a funny way, reflecting the vibe "
+                f"of what you've learned. REMINDER: Do not mention yourself or 'Shady' in the reply.")
+    return ("Say something funny based on what you've learned and the current conversation. "
+            "Remember: NEVER MENTION YOUR NAME.")
+
+
+def _fit(lines, budget, contiguous):
+    """Indexes of `lines`, in order, whose cost fits in `budget`, and the tokens left over."""
+    kept = []
+    for i, line in enumerate(lines):
+        cost = estimate_tokens(line) + 1  # +1 for the newline
+        if cost > budget:
+            if contiguous:
+                break
+            continue
+        kept.append(i)
+        budget -= cost
+    return kept, budget
+
+
+class PromptBuilder:
+    """
+    Builds chat messages for one reply within a token budget.
+
+    The budget is num_ctx minus the tokens reserved for the reply. The static
+    system prompt, the images and the trigger always go in, the trigger cut
+    to at most a quarter of the budget. What is left is shared between chat
+    history (newest lines first, up to history_share of it) and learned
+    messages (in retrieval order); either one gets whatever the other didn't use.
+    """
+
+    def __init__(self, num_ctx=4096, reply_tokens=128, history_share=0.5):
+        self.num_ctx = num_ctx
+        self.reply_tokens = reply_tokens
+        self.history_share = history_share
+        self.stats = {"prompts": 0, "trimmed": 0}
+
+    @property
+    def budget(self):
+        return self.num_ctx - self.reply_tokens - 2 * MESSAGE_OVERHEAD
+
+    def build(self, context_messages, conversation_history=(), user_message=None, image_descriptions=()):
+        budget = self.budget - estimate_tokens(SYSTEM_PROMPT)
+        trimmed = False
+        if user_message:
+            cut = truncate(user_message, max(1, budget // 4))
+            trimmed = cut != user_message
+            user_message = cut
+        request = request_text(user_message, bool(image_descriptions))
+        images_section = ""
+        if image_descriptions:
+            images_section = IMAGES_HEADER + "\n" + "\n".join(
+                f"- Image {i}: {d}" for i, d in enumerate(image_descriptions, 1))
+        budget -= estimate_tokens(request) + estimate_tokens(images_section)
+        budget -= estimate_tokens(VIBE_HEADER) + estimate_tokens(HISTORY_HEADER) + 4
+
+        vibe = [f"- {msg}" for msg in context_messages]
+        # Newest history first, so the lines closest to the trigger survive trimming
+        history = list(reversed(conversation_history or ()))
+        history_budget = int(max(0, budget) * self.history_share)
+        kept_history, history_left = _fit(history, history_budget, contiguous=True)
+        kept_vibe, left = _fit(vibe, max(0, budget) - history_budget + history_left, contiguous=False)
+        if len(kept_history) < len(history):
+            more, _ = _fit(history[len(kept_history):], left, contiguous=True)
+            kept_history += [len(kept_history) + i for i in more]
+
+        self.stats["prompts"] += 1
+        if trimmed or len(kept_history) < len(history) or len(kept_vibe) < len(vibe):
+            self.stats["trimmed"] += 1
+
+        sections = [
+            VIBE_HEADER + "\n" + "\n".join(vibe[i] for i in kept_vibe),
+            HISTORY_HEADER + "\n" + "\n".join(history[i] for i in reversed(kept_history)),
+        ]
+        if images_section:
+            sections.append(images_section)
+        sections.append(request)
+        return [
+            {'role': 'system', 'content': SYSTEM_PROMPT},
+            {'role': 'user', 'content': "\n\n".join(sections)},
+        ]
+
+    @property
+    def options(self):
+        """Ollama options matching the budget; num_ctx must stay fixed or Ollama reloads the model."""
+        return {"num_ctx": self.num_ctx, "num_predict": self.reply_tokens}
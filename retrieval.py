@@ -0,0 +1,175 @@
+import logging
+import os
+import re
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r"\w+")
+
+
+class HashingEmbedder:
+    """
+    Offline embedder using signed feature hashing of words, word bigrams and
+    character trigrams. Needs no model, so it works in tests and when Ollama has
+    no embedding model pulled.
+    """
+
+    def __init__(self, dim=128):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text):
+        words = WORD_RE.findall(text.lower())
+        features = list(words)
+        features += [f"{a} {b}" for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f"#{word}#"
+            features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+        return features
+
+    async def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                # crc32 is stable across runs, unlike hash(), so stored vectors stay valid
+                h = zlib.crc32(feature.encode("utf-8"))
+                vectors[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return normalize(vectors)
+
+
+class OllamaEmbedder:
+    """Embeds text with a local Ollama embedding model such as nomic-embed-text."""
+
+    def __init__(self, model="nomic-embed-text", host=None):
+        import ollama
+        self.client = ollama.AsyncClient(host=host)
+        self.model = model
+        self.name = f"ollama-{model}"
+
+    async def embed(self, texts):
+        response = await self.client.embed(model=self.model, input=list(texts))
+        return normalize(np.asarray(response["embeddings"], dtype=np.float32))
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class EmbeddingIndex:
+    """
+    Unit-length float32 vectors for learned messages in one contiguous matrix,
+    searched by cosine similarity with a single matrix-vector product.
+    Rows are kept ordered by message id, so deletes can find rows with a binary search.
+
+    With `path`, the matrix and ids live in `<path>.vectors.npy` and
+    `<path>.ids.npy` and are memory-mapped, so they are paged in by the OS
+    instead of held in the process heap. Only the first `len(index)` rows are
+    valid; the caller records that size (see Corpus) to reopen them later.
+    """
+
+    def __init__(self, dim, capacity=1024, path=None):
+        self.dim = dim
+        self.path = path
+        self._vectors, self._ids = self._allocate(capacity)
+        self._size = 0
+
+    @classmethod
+    def open(cls, path, size):
+        """Map an index written earlier by an EmbeddingIndex with the same path."""
+        index = cls.__new__(cls)
+        index.path = path
+        index._vectors = np.load(f"{path}.vectors.npy", mmap_mode="r+")
+        index._ids = np.load(f"{path}.ids.npy", mmap_mode="r+")
+        index.dim = index._vectors.shape[1]
+        if size > len(index._ids):
+            raise ValueError(f"{path} holds {len(index._ids)} rows, expected {size}")
+        index._size = size
+        return index
+
+    def _allocate(self, capacity, suffix=""):
+        if self.path is None:
+            return np.zeros((capacity, self.dim), dtype=np.float32), np.zeros(capacity, dtype=np.int64)
+        vectors = np.lib.format.open_memmap(f"{self.path}.vectors.npy{suffix}", mode="w+",
+                                            dtype=np.float32, shape=(capacity, self.dim))
+        ids = np.lib.format.open_memmap(f"{self.path}.ids.npy{suffix}", mode="w+", dtype=np.int64, shape=(capacity,))
+        return vectors, ids
+
+    def flush(self):
+        if self.path is not None:
+            self._vectors.flush()
+            self._ids.flush()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def nbytes(self):
+        return self._vectors.nbytes + self._ids.nbytes
+
+    def _reserve(self, extra):
+        needed = self._size + extra
+        if needed <= len(self._ids):
+            return
+        capacity = max(needed, len(self._ids) * 2)
+        vectors, ids = self._allocate(capacity, suffix=".tmp")
+        vectors[:self._size] = self._vectors[:self._size]
+        ids[:self._size] = self._ids[:self._size]
+        if self.path is not None:
+            # Searches still running in a thread keep the old mapping, which
+            # stays valid after its file is replaced
+            vectors.flush()
+            ids.flush()
+            os.replace(f"{self.path}.vectors.npy.tmp", f"{self.path}.vectors.npy")
+            os.replace(f"{self.path}.ids.npy.tmp", f"{self.path}.ids.npy")
+        self._vectors, self._ids = vectors, ids
+
+    def add(self, ids, vectors):
+        """Add vectors for message ids; ids already in the index are skipped."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if self._size and len(ids):
+            existing = self._ids[:self._size]
+            pos = np.searchsorted(existing, ids)
+            present = existing[np.minimum(pos, self._size - 1)] == ids
+            if present.any():
+                ids, vectors = ids[~present], np.asarray(vectors)[~present]
+        if not len(ids):
+            return
+        self._reserve(len(ids))
+        start, end = self._size, self._size + len(ids)
+        self._ids[start:end] = ids
+        self._vectors[start:end] = vectors
+        self._size = end
+        # New messages always have higher ids; only backfills arrive out of order
+        if start and ids.min() <= self._ids[start - 1]:
+            order = np.argsort(self._ids[:end], kind="stable")
+            self._ids[:end] = self._ids[order]
+            self._vectors[:end] = self._vectors[order]
+
+    def remove(self, ids):
+        if not self._size or not len(ids):
+            return
+        keep = ~np.isin(self._ids[:self._size], np.asarray(ids, dtype=np.int64))
+        kept = int(keep.sum())
+        self._vectors[:kept] = self._vectors[:self._size][keep]
+        self._ids[:kept] = self._ids[:self._size][keep]
+        self._size = kept
+
+    def clear(self):
+        self._size = 0
+
+    def search(self, query, k):
+        """Return up to k message ids, most similar first."""
+        if not self._size or k <= 0:
+            return []
+        scores = self._vectors[:self._size] @ query
+        if k < self._size:
+            top = np.argpartition(-scores, k)[:k]
+            top = top[np.argsort(-scores[top])]
+        else:
+            top = np.argsort(-scores)
+        return self._ids[top].tolist()
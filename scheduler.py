@@ -0,0 +1,159 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from enum import IntEnum
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Why the bot is replying. Lower values are served first."""
+    MENTION = 0
+    BOT = 1
+    VISION = 2
+    RANDOM = 3
+
+
+# Queue depth at which new work of each priority is shed, as a fraction of max_depth
+SHED_AT = {Priority.MENTION: 1.0, Priority.BOT: 1.0, Priority.VISION: 0.5, Priority.RANDOM: 0.25}
+# Seconds a job may wait before it is too stale to be worth answering
+MAX_AGE = {Priority.MENTION: 300.0, Priority.BOT: 60.0, Priority.VISION: 60.0, Priority.RANDOM: 15.0}
+
+
+class ResponseJob:
+    """Pending reply for one channel. Triggers that arrive while it waits are merged into it."""
+
+    def __init__(self, channel_id, priority, message, attachments, created):
+        self.channel_id = channel_id
+        self.priority = priority
+        self.message = message  # The message the reply answers
+        self.attachments = list(attachments)
+        self.created = created
+        self.triggers = 1
+        self.seq = 0
+
+
+class ResponseScheduler:
+    """
+    Runs reply generation on a fixed number of workers, most important first.
+
+    At most one job is pending per channel; later triggers in the same channel
+    are coalesced into it so they get one reply. Low-priority work is shed
+    when the queue gets deep, and any job that waited longer than its
+    priority's MAX_AGE is dropped instead of answered late.
+    """
+
+    def __init__(self, handler, workers=2, max_depth=20, max_age=None, shed_at=None):
+        self.handler = handler
+        self.workers = workers
+        self.max_depth = max_depth
+        self.max_age = {**MAX_AGE, **(max_age or {})}
+        self.shed_at = {**SHED_AT, **(shed_at or {})}
+        self._pending = {}  # channel_id -> ResponseJob
+        self._heap = []  # (priority, seq, channel_id); entries whose seq is stale are skipped
+        self._seq = itertools.count()
+        self._ready = asyncio.Condition()
+        self._tasks = []
+        self.stats = {
+            "submitted": {p.name.lower(): 0 for p in Priority},
+            "dropped": {p.name.lower(): 0 for p in Priority},
+            "expired": {p.name.lower(): 0 for p in Priority},
+            "coalesced": 0,
+            "processed": 0,
+            "errors": 0,
+        }
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._pending.clear()
+        self._heap.clear()
+
+    def _push(self, job):
+        job.seq = next(self._seq)
+        heapq.heappush(self._heap, (job.priority, job.seq, job.channel_id))
+
+    async def submit(self, channel_id, priority, message, attachments=()):
+        """Queue a reply to `message`. Returns False if it was shed."""
+        name = priority.name.lower()
+        self.stats["submitted"][name] += 1
+        now = asyncio.get_running_loop().time()
+
+        job = self._pending.get(channel_id)
+        if job is not None:
+            self.stats["coalesced"] += 1
+            job.triggers += 1
+            job.attachments.extend(attachments)
+            # Answer the most important trigger, and the latest one among equals
+            if priority <= job.priority:
+                job.message = message
+            if priority < job.priority:
+                job.priority = priority
+                self._push(job)
+            return True
+
+        if self.depth >= self.max_depth * self.shed_at[priority]:
+            if not self._evict_below(priority):
+                self.stats["dropped"][name] += 1
+                return False
+
+        job = ResponseJob(channel_id, priority, message, attachments, now)
+        self._pending[channel_id] = job
+        self._push(job)
+        async with self._ready:
+            self._ready.notify()
+        return True
+
+    def _evict_below(self, priority):
+        """Drop the least important, oldest pending job if it ranks below `priority`."""
+        if not self._pending:
+            return False
+        victim = max(self._pending.values(), key=lambda j: (j.priority, -j.created))
+        if victim.priority <= priority:
+            return False
+        del self._pending[victim.channel_id]
+        self.stats["dropped"][victim.priority.name.lower()] += 1
+        return True
+
+    def _pop(self):
+        while self._heap:
+            _, seq, channel_id = heapq.heappop(self._heap)
+            job = self._pending.get(channel_id)
+            if job is not None and job.seq == seq:
+                del self._pending[channel_id]
+                return job
+        return None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self._ready:
+                job = self._pop()
+                while job is None:
+                    await self._ready.wait()
+                    job = self._pop()
+
+            waited = loop.time() - job.created
+            if waited > self.max_age[job.priority]:
+                self.stats["expired"][job.priority.name.lower()] += 1
+                continue
+            metrics.observe("response_queue_seconds", waited, priority=job.priority.name.lower())
+            try:
+                await self.handler(job)
+                self.stats["processed"] += 1
+            except Exception:
+                self.stats["errors"] += 1
+                metrics.inc("response_errors_total")
+                logger.exception(f"Error generating response in channel {job.channel_id}")
@@ -0,0 +1,227 @@
+"""
+A stand-in for the Ollama HTTP API, for benchmarks and local runs without a GPU.
+
+It answers /api/chat (streaming and not), /api/generate, /api/embed, /api/pull,
+/api/tags and /api/version with canned output and configurable latency. With
+--prompt-token-ms set, time to first token also grows with the part of the
+prompt that isn't a prefix of a recent prompt, like Ollama's KV cache reuse.
+With --load-ms set, a request for a model that isn't loaded waits that long
+first, and --max-loaded caps how many models stay loaded at once.
+
+Usage:
+    uv run stub_ollama.py [--port 11434] [--first-token-ms 300] [--token-ms 20] [--prompt-token-ms 0]
+                        [--load-ms 0] [--max-loaded 0]
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+import zlib
+from collections import OrderedDict
+
+from aiohttp import web
+
+DEFAULT_REPLY = (
+    "lmao that is exactly what the group chat needed today. "
+    "somebody screenshot this before it gets deleted. "
+    "honestly no notes, ten out of ten, would read again."
+)
+
+
+class StubOllama:
+    def __init__(self, reply=DEFAULT_REPLY, first_token_delay=0.3, token_delay=0.02,
+                 models=("llama3.2:3b", "llava", "nomic-embed-text"), embed_dim=64,
+                 prompt_token_delay=0.0, cache_slots=4, load_delay=0.0, max_loaded=None):
+        self.reply = reply
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        # Seconds per prompt token that isn't already cached
+        self.prompt_token_delay = prompt_token_delay
+        self.cache_slots = cache_slots
+        self._cache = {}  # model -> recent prompts, least recently used first
+        self.load_delay = load_delay
+        self.max_loaded = max_loaded
+        self.loaded = OrderedDict()  # model -> load future, least recently used first
+        self.models = list(models)
+        self.embed_dim = embed_dim
+        self.in_flight = 0
+        self.stats = {"requests": 0, "max_in_flight": 0, "tokens_sent": 0, "disconnects": 0,
+                      "prompt_tokens": 0, "cached_prompt_tokens": 0, "loads": 0}
+        self.requests = []  # Parsed request bodies, newest last
+        self._runner = None
+        self.url = None
+
+    def _tokens(self):
+        words = self.reply.split(" ")
+        return [word + " " for word in words[:-1]] + words[-1:]
+
+    async def _ensure_loaded(self, model):
+        load = self.loaded.get(model)
+        if load is None:
+            self.stats["loads"] += 1
+            load = self.loaded[model] = asyncio.ensure_future(asyncio.sleep(self.load_delay))
+            while self.max_loaded and len(self.loaded) > self.max_loaded:
+                self.loaded.popitem(last=False)
+        self.loaded.move_to_end(model)
+        # Requests that arrive while the model loads wait for the same load
+        await asyncio.shield(load)
+
+    def _evaluate_prompt(self, model, body):
+        """Return (prompt tokens to evaluate, delay before the first token), updating the prefix cache."""
+        if "messages" in body:
+            prompt = "".join(f"<{m.get('role')}>{m.get('content', '')}" for m in body["messages"])
+        else:
+            prompt = body.get("prompt", "")
+        slots = self._cache.setdefault(model, [])
+        best, cached = None, 0
+        for i, previous in enumerate(slots):
+            shared = len(os.path.commonprefix([previous, prompt]))
+            if shared > cached:
+                best, cached = i, shared
+        # Reuse the slot with the longest shared prefix, else the least recently used one
+        if best is not None:
+            slots.pop(best)
+        elif len(slots) >= self.cache_slots:
+            slots.pop(0)
+        slots.append(prompt)
+        total = (len(prompt.encode("utf-8")) + 3) // 4
+        evaluated = (len(prompt[cached:].encode("utf-8")) + 3) // 4
+        self.stats["prompt_tokens"] += total
+        self.stats["cached_prompt_tokens"] += total - evaluated
+        return evaluated, self.first_token_delay + self.prompt_token_delay * evaluated
+
+    def _final_chunk(self, model, eval_count, started, prompt_eval_count, prompt_delay):
+        elapsed = time.perf_counter() - started
+        return {
+            "model": model,
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": int(elapsed * 1e9),
+            "load_duration": 0,
+            "prompt_eval_count": prompt_eval_count,
+            "prompt_eval_duration": int(prompt_delay * 1e9),
+            "eval_count": eval_count,
+            "eval_duration": int(max(elapsed - prompt_delay, 1e-6) * 1e9),
+        }
+
+    async def handle_chat(self, request):
+        return await self._complete(request, lambda text: {"message": {"role": "assistant", "content": text}})
+
+    async def handle_generate(self, request):
+        return await self._complete(request, lambda text: {"response": text})
+
+    async def _complete(self, request, wrap):
+        body = await request.json()
+        self.requests.append(body)
+        self.stats["requests"] += 1
+        self.in_flight += 1
+        self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.in_flight)
+        started = time.perf_counter()
+        model = body.get("model", "")
+        try:
+            await self._ensure_loaded(model)
+            if not body.get("messages") and not body.get("prompt"):
+                # Empty request: Ollama just loads the model
+                return web.json_response({"model": model, "done": True, **wrap("")})
+            tokens = self._tokens()
+            prompt_tokens, prompt_delay = self._evaluate_prompt(model, body)
+            if not body.get("stream", True):
+                await asyncio.sleep(prompt_delay + self.token_delay * len(tokens))
+                self.stats["tokens_sent"] += len(tokens)
+                final = self._final_chunk(model, len(tokens), started, prompt_tokens, prompt_delay)
+                return web.json_response({**wrap("".join(tokens)), **final})
+
+            resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+            await resp.prepare(request)
+            await asyncio.sleep(prompt_delay)
+            sent = 0
+            try:
+                for token in tokens:
+                    await resp.write(json.dumps({"model": model, "done": False, **wrap(token)}).encode() + b"\n")
+                    sent += 1
+                    self.stats["tokens_sent"] += 1
+                    await asyncio.sleep(self.token_delay)
+                final = {**wrap(""), **self._final_chunk(model, sent, started, prompt_tokens, prompt_delay)}
+                await resp.write(json.dumps(final).encode() + b"\n")
+                await resp.write_eof()
+            except (ConnectionResetError, asyncio.CancelledError):
+                # The client hung up, e.g. after stopping a stream early
+                self.stats["disconnects"] += 1
+            return resp
+        finally:
+            self.in_flight -= 1
+
+    async def handle_embed(self, request):
+        body = await request.json()
+        self.requests.append(body)
+        self.stats["requests"] += 1
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        embeddings = []
+        for text in inputs:
+            vector = [0.0] * self.embed_dim
+            for word in text.lower().split():
+                vector[zlib.crc32(word.encode()) % self.embed_dim] += 1.0
+            embeddings.append(vector)
+        return web.json_response({"model": body.get("model"), "embeddings": embeddings})
+
+    async def handle_pull(self, request):
+        body = await request.json()
+        self.requests.append(body)
+        if body["model"] not in self.models:
+            self.models.append(body["model"])
+        return web.json_response({"status": "success"})
+
+    async def handle_tags(self, request):
+        return web.json_response({"models": [{"name": name, "model": name} for name in self.models]})
+
+    async def handle_version(self, request):
+        return web.json_response({"version": "0.0.0-stub"})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/api/chat", self.handle_chat)
+        app.router.add_post("/api/generate", self.handle_generate)
+        app.router.add_post("/api/embed", self.handle_embed)
+        app.router.add_post("/api/pull", self.handle_pull)
+        app.router.add_get("/api/tags", self.handle_tags)
+        app.router.add_get("/api/version", self.handle_version)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start serving in the current event loop and return the base URL."""
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{bound_port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--first-token-ms", type=float, default=300)
+    parser.add_argument("--token-ms", type=float, default=20)
+    parser.add_argument("--prompt-token-ms", type=float, default=0,
+                        help="added time to first token per uncached prompt token")
+    parser.add_argument("--load-ms", type=float, default=0, help="time to load a model that isn't loaded")
+    parser.add_argument("--max-loaded", type=int, default=0, help="models kept loaded at once (0 for no limit)")
+    args = parser.parse_args()
+    stub = StubOllama(first_token_delay=args.first_token_ms / 1000, token_delay=args.token_ms / 1000,
+                      prompt_token_delay=args.prompt_token_ms / 1000, load_delay=args.load_ms / 1000,
+                      max_loaded=args.max_loaded or None)
+    web.run_app(stub.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
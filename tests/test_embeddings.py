@@ -0,0 +1,61 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from database import DatabaseManager
+from retrieval import HashingEmbedder
+
+
+class GatedEmbedder(HashingEmbedder):
+    """Blocks every embed() call until `gate` is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.started = asyncio.Event()
+        self.gate = asyncio.Event()
+
+    async def embed(self, texts):
+        self.started.set()
+        await self.gate.wait()
+        return await super().embed(texts)
+
+
+class EmbeddingTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.embedder = GatedEmbedder()
+        self.db = DatabaseManager(os.path.join(self.tmp.name, "test.db"), embedder=self.embedder,
+                                  dedup_threshold=None)
+        await self.db.initialize()
+        await self.db.set_opt_in(1, True)
+
+    async def asyncTearDown(self):
+        self.embedder.gate.set()
+        await self.db.close()
+        self.tmp.cleanup()
+
+    async def embedding_rows(self):
+        async with self.db.db.execute("SELECT COUNT(*) FROM message_embeddings") as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def test_rows_deleted_while_embedding_are_not_indexed(self):
+        for i in range(5):
+            await self.db.log_message(1, f"message number {i}", guild_id=1)
+        written = asyncio.create_task(self.db.flush())
+        await self.embedder.started.wait()
+        # A deletion batch lands between the insert and the embedding
+        await self.db._shared.delete_where("1")
+        self.embedder.gate.set()
+        await written
+        self.assertEqual(await self.embedding_rows(), 0)
+        self.assertEqual(self.db.embedding_count, 0)
+
+        await self.db.log_message(1, "still here", guild_id=1)
+        await self.db.flush()
+        self.assertEqual(await self.embedding_rows(), 1)
+        self.assertEqual(self.db.embedding_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import base64
+import io
+import os
+import unittest
+from types import SimpleNamespace
+
+import aiohttp
+from aiohttp import web
+from PIL import Image
+
+from images import ImageFetcher
+
+MAX_BYTES = 64 * 1024
+
+
+def png(width, height):
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 40, 90)).save(out, format="PNG")
+    return out.getvalue()
+
+
+class ImageFetcherTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.hits = []
+        self.payloads = {"small.png": png(32, 32), "large.png": png(2000, 1000), "big.bin": os.urandom(4 * MAX_BYTES)}
+
+        async def fixed(request):
+            self.hits.append(request.match_info["name"])
+            return web.Response(body=self.payloads[request.match_info["name"]], content_type="image/png")
+
+        async def chunked(request):
+            # No Content-Length, so only the capped read can catch it
+            self.hits.append("chunked")
+            resp = web.StreamResponse(headers={"Content-Type": "image/png"})
+            resp.enable_chunked_encoding()
+            await resp.prepare(request)
+            try:
+                for _ in range(64):
+                    await resp.write(os.urandom(16 * 1024))
+                await resp.write_eof()
+            except ConnectionResetError:
+                pass
+            return resp
+
+        app = web.Application()
+        app.router.add_get("/chunked", chunked)
+        app.router.add_get("/{name}", fixed)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        self.session = aiohttp.ClientSession()
+        self.fetcher = ImageFetcher(self.session, max_bytes=MAX_BYTES, chunk_size=8 * 1024)
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.runner.cleanup()
+
+    def attachment(self, name, size=None):
+        return SimpleNamespace(url=f"{self.url}/{name}", filename=name, size=size)
+
+    async def test_rejects_by_attachment_size(self):
+        self.assertIsNone(await self.fetcher.fetch(self.attachment("big.bin", size=4 * MAX_BYTES)))
+        self.assertEqual(self.hits, [])
+        self.assertEqual(self.fetcher.stats["rejected_size"], 1)
+
+    async def test_rejects_by_content_length(self):
+        self.assertIsNone(await self.fetcher.fetch(self.attachment("big.bin")))
+        self.assertEqual(self.hits, ["big.bin"])
+        self.assertEqual(self.fetcher.stats["rejected_size"], 1)
+        self.assertEqual(self.fetcher.stats["bytes_downloaded"], 0)
+
+    async def test_rejects_by_capped_read(self):
+        self.assertIsNone(await self.fetcher.fetch(self.attachment("chunked")))
+        self.assertEqual(self.fetcher.stats["rejected_size"], 1)
+        self.assertGreater(self.fetcher.stats["bytes_downloaded"], MAX_BYTES)
+        self.assertLessEqual(self.fetcher.stats["bytes_downloaded"], MAX_BYTES + self.fetcher.chunk_size)
+
+    async def test_downscales_large_images(self):
+        small, large = await self.fetcher.fetch_all([self.attachment("small.png"), self.attachment("large.png")])
+        self.assertEqual(base64.b64decode(small), self.payloads["small.png"])
+        with Image.open(io.BytesIO(base64.b64decode(large))) as image:
+            self.assertEqual(image.size, (672, 336))
+        self.assertEqual(self.fetcher.stats["fetched"], 2)
+        self.assertLess(self.fetcher.stats["bytes_sent"], self.fetcher.stats["bytes_downloaded"])
+
+
+if __name__ == "__main__":
+    unittest.main()
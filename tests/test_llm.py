@@ -0,0 +1,46 @@
+import asyncio
+import unittest
+
+from llm import OllamaClient, OllamaUnavailable
+from stub_ollama import StubOllama
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+class OllamaClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.stub = StubOllama(first_token_delay=0.0, token_delay=0.01)
+        self.client = OllamaClient(await self.stub.start(), max_concurrency=2, timeout=5.0)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.stub.stop()
+
+    async def test_semaphore_caps_requests_in_flight(self):
+        replies = await asyncio.gather(*(self.client.chat("llama3.2:3b", MESSAGES) for _ in range(6)))
+        self.assertEqual(replies, [self.stub.reply] * 6)
+        self.assertEqual(self.stub.stats["max_in_flight"], 2)
+        self.assertEqual((self.client.in_flight, self.client.waiting), (0, 0))
+
+    async def test_timeout_raises_unavailable(self):
+        self.stub.token_delay = 0.5
+        with self.assertRaises(OllamaUnavailable):
+            await self.client.chat("llama3.2:3b", MESSAGES, stream=True, timeout=0.2)
+        self.assertEqual(self.client.stats["timeouts"], 1)
+        self.assertEqual(self.client.in_flight, 0)
+
+    async def test_stream_stops_after_sentences(self):
+        reply = await self.client.chat("llama3.2:3b", MESSAGES, stream=True, stop_after_sentences=1)
+        self.assertEqual(reply, "lmao that is exactly what the group chat needed today.")
+        self.assertEqual(self.client.stats["stopped_early"], 1)
+        # The stub notices the hang-up on its next write
+        for _ in range(50):
+            if self.stub.stats["disconnects"]:
+                break
+            await asyncio.sleep(0.02)
+        self.assertEqual(self.stub.stats["disconnects"], 1)
+        self.assertLess(self.stub.stats["tokens_sent"], len(self.stub.reply.split()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import asyncio
+import unittest
+
+from llm import OllamaClient, OllamaEndpoint, OllamaPool
+from stub_ollama import StubOllama
+
+TEXT_MODEL = "llama3.2:3b"
+VISION_MODEL = "llava"
+MESSAGES = [{"role": "user", "content": "hi"}]
+OPTIONS = {"num_ctx": 8192, "num_predict": 128}
+
+
+def make_stub():
+    return StubOllama(reply="short reply. another one.", first_token_delay=0.0, token_delay=0.05)
+
+
+class OllamaPoolTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # Two text servers and one vision server
+        self.stubs = [make_stub() for _ in range(3)]
+        self.urls = [await stub.start() for stub in self.stubs]
+        tags = [[TEXT_MODEL], [TEXT_MODEL], [VISION_MODEL]]
+        self.pool = OllamaPool([OllamaEndpoint(OllamaClient(url, max_concurrency=2, timeout=5.0), models)
+                                for url, models in zip(self.urls, tags)], probe_interval=0.05)
+
+    async def asyncTearDown(self):
+        await self.pool.close()
+        for stub in self.stubs:
+            await stub.stop()
+
+    def served(self):
+        """Models each stub was asked for, in stub order."""
+        return [sorted({r["model"] for r in stub.requests}) for stub in self.stubs]
+
+    async def wait_for(self, condition, timeout=5.0):
+        for _ in range(int(timeout / 0.02)):
+            if condition():
+                return
+            await asyncio.sleep(0.02)
+        self.fail("condition not met in time")
+
+    async def test_routes_by_model_tag(self):
+        await asyncio.gather(*(self.pool.chat(TEXT_MODEL, MESSAGES) for _ in range(3)),
+                             self.pool.chat(VISION_MODEL, MESSAGES))
+        self.assertEqual(self.served(), [[TEXT_MODEL], [TEXT_MODEL], [VISION_MODEL]])
+        self.assertEqual(self.pool.stats["failovers"], 0)
+
+    async def test_routes_to_least_loaded(self):
+        first = asyncio.create_task(self.pool.chat(TEXT_MODEL, MESSAGES))
+        await self.wait_for(lambda: self.pool.in_flight == 1)
+        await self.pool.chat(TEXT_MODEL, MESSAGES)
+        await first
+        self.assertEqual([len(stub.requests) for stub in self.stubs], [1, 1, 0])
+
+    async def test_fails_over_to_endpoint_tagged_for_other_model(self):
+        await self.stubs[2].stop()
+        reply = await self.pool.chat(VISION_MODEL, MESSAGES)
+        self.assertEqual(reply, self.stubs[0].reply)
+        self.assertFalse(self.pool.endpoints[2].healthy)
+        self.assertEqual(self.pool.stats, {"failovers": 1, "ejections": 1, "recoveries": 0})
+        self.assertIn(VISION_MODEL, self.served()[0] + self.served()[1])
+
+    async def test_probe_restores_and_rewarms(self):
+        await self.pool.warm(options={TEXT_MODEL: OPTIONS})
+        port = int(self.urls[0].rsplit(":", 1)[1])
+        await self.stubs[0].stop()
+        await self.pool.chat(TEXT_MODEL, MESSAGES)
+        self.assertFalse(self.pool.endpoints[0].healthy)
+
+        self.stubs[0] = make_stub()
+        await self.stubs[0].start(port=port)
+        self.pool.start()
+        await self.wait_for(lambda: self.pool.endpoints[0].healthy and self.stubs[0].requests)
+        self.assertEqual(self.pool.stats["recoveries"], 1)
+        # Re-warmed with the same options replies use, so the first reply doesn't reload it
+        self.assertEqual(self.stubs[0].requests, [{"model": TEXT_MODEL, "options": OPTIONS}])
+        self.assertIn(TEXT_MODEL, self.stubs[0].loaded)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from database import DatabaseManager
+
+USERS = 20
+CUTOFF = "2024-06-01 00:00:00"
+
+
+def fill_legacy(path, rows=600):
+    """A database from before guilds and user_stats: learned messages spread over the first half of 2024 and after."""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE learned_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, "
+                 "content TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
+    conn.executemany(
+        "INSERT INTO learned_messages (user_id, content, timestamp) VALUES (?, ?, ?)",
+        [(i % USERS if i % 50 else i % 3, f"legacy message {i}", f"2024-{1 + i % 12:02d}-15 12:00:00")
+         for i in range(rows)],
+    )
+    conn.commit()
+    conn.close()
+
+
+class StatsConsistencyTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, "test.db")
+        fill_legacy(path)
+        self.db = DatabaseManager(path, dedup_threshold=None, legacy_guild_id=1)
+        await self.db.initialize()
+        for corpus in self.db._corpora:
+            await corpus._backfill_task
+        for user_id in range(0, USERS, 2):
+            await self.db.set_opt_in(user_id, True)
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        self.tmp.cleanup()
+
+    async def scalar(self, sql, params=()):
+        async with self.db.db.execute(sql, params) as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def aggregate_stats(self, guild_id=None):
+        """The full-table queries /stats used to run."""
+        where, params = ("WHERE guild_id = ?", (guild_id,)) if guild_id is not None else ("", ())
+        opted_in = await self.scalar("SELECT COUNT(*) FROM user_prefs WHERE opt_in = 1")
+        total = await self.scalar(f"SELECT COUNT(*) FROM learned_messages {where}", params)
+        async with self.db.db.execute(f"""
+            SELECT user_id, COUNT(*) AS msg_count FROM learned_messages {where}
+            GROUP BY user_id ORDER BY msg_count DESC, user_id LIMIT 3
+        """, params) as cursor:
+            top = [tuple(row) for row in await cursor.fetchall()]
+        return opted_in, total, top
+
+    async def assertConsistent(self):
+        await self.db.flush()
+        self.assertEqual(await self.db.verify_stats(), [])
+        for guild_id in (None, 1, 2):
+            opted_in, total, top = await self.db.get_stats(guild_id=guild_id)
+            self.assertEqual((opted_in, total, [tuple(row) for row in top]), await self.aggregate_stats(guild_id))
+
+    async def ingest(self, count=300):
+        for i in range(count):
+            await self.db.log_message(i % USERS // 2 * 2, f"new message {i}", guild_id=1 + i % 2)
+
+    async def test_backfill(self):
+        await self.assertConsistent()
+        self.assertEqual(self.db.message_count(1), 600)
+
+    async def test_ingest(self):
+        await self.ingest()
+        await self.assertConsistent()
+        self.assertEqual(self.db.message_count(2), 150)
+
+    async def test_clear_messages_before(self):
+        await self.ingest()
+        await self.db.clear_messages_before(CUTOFF, guild_id=2)
+        await self.assertConsistent()
+        await self.db.clear_messages_before(CUTOFF)
+        await self.assertConsistent()
+        self.assertEqual(await self.scalar("SELECT COUNT(*) FROM learned_messages WHERE timestamp < ?", (CUTOFF,)), 0)
+
+    async def test_clear_messages_after(self):
+        await self.ingest()
+        await self.db.clear_messages_after(CUTOFF, guild_id=2)
+        await self.assertConsistent()
+        self.assertEqual(self.db.message_count(2), 0)
+        await self.db.clear_messages_after(CUTOFF)
+        await self.assertConsistent()
+        self.assertGreater(self.db.message_count(), 0)
+
+    async def test_clear_all_messages(self):
+        await self.ingest()
+        await self.db.clear_all_messages(guild_id=1)
+        await self.assertConsistent()
+        self.assertEqual((self.db.message_count(1), self.db.message_count(2)), (0, 150))
+        await self.db.clear_all_messages()
+        await self.assertConsistent()
+        self.assertEqual(self.db.message_count(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()